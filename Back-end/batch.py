@@ -0,0 +1,262 @@
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Set
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Records of a batch generated at the same time (0: one less than the chat lane runs at once, at least 1)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "0"))
+# Records read ahead of the oldest unfinished one, which bounds memory and the checkpoint size
+BATCH_WINDOW = int(os.getenv("BATCH_WINDOW", "256"))
+# Directory that the paths of /batch jobs are relative to
+BATCH_DIR = os.getenv("BATCH_DIR", "batch_jobs")
+# Finished jobs kept for status lookups
+BATCH_JOB_HISTORY = int(os.getenv("BATCH_JOB_HISTORY", "100"))
+
+# Resolve a path of a /batch job inside BATCH_DIR
+def resolve_batch_path(path: str) -> str:
+    root = os.path.realpath(BATCH_DIR)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"Batch paths must stay inside {BATCH_DIR}")
+    return resolved
+
+# Input lines that are finished: every line below `watermark`, plus the finished lines above it.
+# Saved next to the output after each record so an interrupted job resumes where it stopped.
+class Checkpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self.watermark = 0
+        self.done: Set[int] = set()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                state = json.load(file)
+            self.watermark = state["watermark"]
+            self.done = set(state["done"])
+
+    def is_done(self, line: int) -> bool:
+        return line < self.watermark or line in self.done
+
+    def mark(self, line: int):
+        self.done.add(line)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+
+    def save(self):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump({"watermark": self.watermark, "done": sorted(self.done)}, file)
+        os.replace(temporary, self.path)
+
+# One batch of JSONL {session_id, request} records and its progress
+class BatchJob:
+    def __init__(self, input_path: str, output_path: str):
+        self.id = uuid.uuid4().hex
+        self.input_path = input_path
+        self.output_path = output_path
+        self.checkpoint_path = f"{output_path}.checkpoint"
+        self.status = "queued"
+        self.read = 0
+        self.skipped = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def to_dict(self) -> dict:
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0
+        processed = self.completed + self.failed
+        return {
+            "id": self.id,
+            "input_path": self.input_path,
+            "output_path": self.output_path,
+            "status": self.status,
+            "read": self.read,
+            "skipped": self.skipped,
+            "completed": self.completed,
+            "failed": self.failed,
+            "in_flight": self.in_flight,
+            "records_per_second": round(processed / elapsed, 3) if elapsed > 0 else None,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+# Runs batch jobs on the event loop through `process(record, idempotency_key)`, which returns a JSON-able result.
+# Records of one session are processed in input order (each turn is the context of the next one);
+# different sessions run concurrently, up to `concurrency` records at a time.
+# The idempotency key of a record is stable across resumes, so a record whose turn was saved
+# before an interruption gets its stored response instead of a second turn.
+class BatchRunner:
+    def __init__(self, process: Callable[[dict, str], Awaitable[dict]], concurrency: int, window: int = BATCH_WINDOW):
+        self.process = process
+        self.concurrency = max(1, concurrency)
+        self.window = max(1, window)
+        self._jobs: "OrderedDict[str, BatchJob]" = OrderedDict()
+
+    # Start a job in the background
+    def submit(self, input_path: str, output_path: str) -> BatchJob:
+        if not os.path.exists(input_path):
+            raise FileNotFoundError(f"Batch input not found: {input_path}")
+        # Absolute paths keep the idempotency keys of a resumed job the same
+        job = BatchJob(os.path.realpath(input_path), os.path.realpath(output_path))
+        self._jobs[job.id] = job
+        while len(self._jobs) > BATCH_JOB_HISTORY:
+            oldest = next(iter(self._jobs.values()))
+            if oldest.status in ("queued", "running"):
+                break
+            self._jobs.popitem(last=False)
+        job.task = asyncio.create_task(self.run(job))
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        return self._jobs.get(job_id)
+
+    # Stop a job; its checkpoint is kept, so submitting the same files again resumes it
+    def cancel(self, job_id: str) -> Optional[BatchJob]:
+        job = self._jobs.get(job_id)
+        if job is not None and job.task is not None and not job.task.done():
+            job.task.cancel()
+        return job
+
+    async def run(self, job: BatchJob):
+        job.status = "running"
+        job.started_at = time.time()
+        checkpoint = Checkpoint(job.checkpoint_path)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        window = asyncio.Semaphore(self.window)
+        # Last record of each session, which the session's next record waits for
+        tails: Dict[str, asyncio.Task] = {}
+        tasks: Set[asyncio.Task] = set()
+
+        def forget_tail(session_id: str, task: asyncio.Task):
+            if tails.get(session_id) is task:
+                del tails[session_id]
+
+        output = open(job.output_path, "a", encoding="utf-8")
+
+        # Write the result of a line, then mark it finished, so a resumed job neither repeats nor loses it
+        def finish(line: int, result: dict):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            checkpoint.mark(line)
+            checkpoint.save()
+
+        async def handle(line: int, record: dict, previous: Optional[asyncio.Task]):
+            try:
+                if previous is not None:
+                    await asyncio.wait([previous])
+                async with semaphore:
+                    job.in_flight += 1
+                    try:
+                        result = {"line": line, "status": "ok", "response": await self.process(record, f"batch:{job.input_path}:{line}")}
+                        job.completed += 1
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        result = {"line": line, "status": "error", "request": record, "error": str(e)}
+                        job.failed += 1
+                    finally:
+                        job.in_flight -= 1
+                finish(line, result)
+            finally:
+                window.release()
+
+        try:
+            with open(job.input_path, "r", encoding="utf-8") as file:
+                for line, text in enumerate(file):
+                    if checkpoint.is_done(line):
+                        job.skipped += 1
+                        continue
+                    if not text.strip():
+                        checkpoint.mark(line)
+                        continue
+                    await window.acquire()
+                    job.read += 1
+                    try:
+                        record = json.loads(text)
+                        session_id = record["session_id"]
+                    except (ValueError, KeyError, TypeError) as e:
+                        # A malformed line is reported like a failed record
+                        record = {"raw": text.strip()}
+                        job.failed += 1
+                        finish(line, {"line": line, "status": "error", "request": record, "error": f"Malformed record: {e}"})
+                        window.release()
+                        continue
+                    task = asyncio.create_task(handle(line, record, tails.get(session_id)))
+                    tails[session_id] = task
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    task.add_done_callback(lambda done, session_id=session_id: forget_tail(session_id, done))
+            if tasks:
+                await asyncio.gather(*tasks)
+            job.status = "done"
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            job.status = "cancelled"
+        except Exception as e:
+            for task in tasks:
+                task.cancel()
+            job.status = "failed"
+            job.error = str(e)
+            print(f"Batch job {job.id} failed: {e}")
+        finally:
+            checkpoint.save()
+            output.close()
+            job.finished_at = time.time()
+
+    # Stop the running jobs at shutdown; they resume from their checkpoints
+    async def shutdown(self):
+        running = [job.task for job in self._jobs.values() if job.task is not None and not job.task.done()]
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.wait(running)
+
+    def stats(self) -> dict:
+        jobs = list(self._jobs.values())
+        return {
+            "concurrency": self.concurrency,
+            "running": sum(job.status == "running" for job in jobs),
+            "completed_records": sum(job.completed for job in jobs),
+            "failed_records": sum(job.failed for job in jobs),
+        }
+
+# Process a JSONL file through the same pipeline as /generate-response, without the HTTP server:
+#   python batch.py requests.jsonl responses.jsonl
+# Run it again with the same files to resume after an interruption.
+async def run_cli(input_path: str, output_path: str):
+    import main
+    await main.startup()
+    await main.lifecycle.load(main.load_models)
+    job = main.batch_runner.submit(input_path, output_path)
+    try:
+        while not job.task.done():
+            await asyncio.wait([job.task], timeout=10)
+            progress = job.to_dict()
+            print(f"Batch {progress['status']}: {progress['completed']} done, {progress['failed']} failed, "
+                  f"{progress['skipped']} skipped, {progress['records_per_second']} records/s")
+    finally:
+        await main.shutdown()
+    return job
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python batch.py INPUT.jsonl OUTPUT.jsonl")
+        sys.exit(2)
+    finished = asyncio.run(run_cli(sys.argv[1], sys.argv[2]))
+    sys.exit(0 if finished.status == "done" else 1)
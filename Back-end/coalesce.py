@@ -0,0 +1,53 @@
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Dict, Tuple, Type
+
+# Stable key of a request from its parts
+def request_key(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+# Single-flight: concurrent calls with the same key share one in-flight task.
+# The task is shielded, so it keeps running for the other callers when one of them goes away.
+# If it fails with one of `retry_on` (e.g. its first caller disconnected), a waiting caller runs it again.
+class SingleFlight:
+    def __init__(self, name: str, retry_on: Tuple[Type[BaseException], ...] = ()):
+        self.name = name
+        self.retry_on = retry_on
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        while True:
+            task = self._inflight.get(key)
+            leader = task is None
+            if leader:
+                task = asyncio.ensure_future(fn())
+                self._inflight[key] = task
+                task.add_done_callback(lambda done, key=key: self._forget(key, done))
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+            try:
+                return await asyncio.shield(task)
+            except self.retry_on:
+                if leader:
+                    raise
+                self.retried += 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+        }
@@ -0,0 +1,140 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Sessions whose context is kept in memory
+CONTEXT_CACHE_SESSIONS = int(os.getenv("CONTEXT_CACHE_SESSIONS", "1024"))
+
+# One conversation turn, rendered once in both of its prompt forms
+class CachedTurn:
+    __slots__ = ("id", "full", "full_tokens", "summarized", "summarized_tokens")
+
+    def __init__(self, id: int, full: str, full_tokens: int, summarized: Optional[str] = None, summarized_tokens: Optional[int] = None):
+        self.id = id
+        self.full = full
+        self.full_tokens = full_tokens
+        self.summarized = summarized
+        self.summarized_tokens = summarized_tokens
+
+# Cached context of a session: its newest turns, oldest first, and its rolling memory.
+# The memory is a CachedTurn whose id is the last turn folded into it.
+# Entries are replaced, never mutated, so a request can keep packing the one it read.
+class SessionContext:
+    __slots__ = ("turns", "memory")
+
+    def __init__(self, turns: List[CachedTurn], memory: Optional[CachedTurn] = None):
+        self.turns = turns
+        self.memory = memory
+
+    # Id of the newest turn the entry covers (0 for an empty session), comparable with database.session_tip()
+    @property
+    def tip(self) -> int:
+        if self.turns:
+            return self.turns[-1].id
+        return self.memory.id if self.memory is not None else 0
+
+# LRU of the context of the active sessions.
+# Filled from the database on a miss, then kept current write-through by the code that commits turns.
+class ContextCache:
+    def __init__(self, max_turns: int, max_sessions: int = CONTEXT_CACHE_SESSIONS):
+        self.max_turns = max_turns
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, SessionContext]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Sequence number of the latest write per session, so a load that raced a write is not cached.
+        # Bounded like the sessions; a load older than every forgotten write is not cached either.
+        self._seq = 0
+        self._last_write: "OrderedDict[str, int]" = OrderedDict()
+        self._forgotten_seq = 0
+        self.hits = 0
+        self.misses = 0
+        self.appends = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    # Cached context of a session, or None and the sequence number to pass to put() after loading
+    def get(self, session_id: str):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                self._sessions.move_to_end(session_id)
+                self.hits += 1
+                return entry, None
+            self.misses += 1
+            return None, self._seq
+
+    # Cache a context loaded from the database, unless the session was written since `seq`
+    def put(self, session_id: str, entry: SessionContext, seq: int):
+        with self._lock:
+            if seq < self._forgotten_seq or self._last_write.get(session_id, -1) > seq:
+                return
+            self._sessions[session_id] = SessionContext(entry.turns[-self.max_turns:], entry.memory)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def _written(self, session_id: str):
+        self._seq += 1
+        self._last_write[session_id] = self._seq
+        self._last_write.move_to_end(session_id)
+        while len(self._last_write) > 4 * self.max_sessions:
+            _, seq = self._last_write.popitem(last=False)
+            self._forgotten_seq = seq
+
+    # Write-through of a committed turn; a session that is not cached is loaded on its next read
+    def append(self, session_id: str, turn: CachedTurn):
+        with self._lock:
+            self._written(session_id)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return
+            # Copy on write: a request may still be packing the previous entry
+            self._sessions[session_id] = SessionContext((entry.turns + [turn])[-self.max_turns:], entry.memory)
+            self.appends += 1
+
+    # Apply `update(turn)` to the cached turn with this row id, if it is still cached
+    def update(self, session_id: str, row_id: int, update: Callable[[CachedTurn], CachedTurn]):
+        with self._lock:
+            self._written(session_id)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return
+            self._sessions[session_id] = SessionContext([update(turn) if turn.id == row_id else turn for turn in entry.turns], entry.memory)
+
+    # Replace the rolling memory of a session, if it is cached
+    def set_memory(self, session_id: str, memory: CachedTurn):
+        with self._lock:
+            self._written(session_id)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return
+            self._sessions[session_id] = SessionContext(entry.turns, memory)
+
+    # Id of the newest turn of a cached session (without counting a lookup), or None when it is not cached
+    def tip(self, session_id: str) -> Optional[int]:
+        entry = self._sessions.get(session_id)
+        return entry.tip if entry is not None else None
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            self._written(session_id)
+            if self._sessions.pop(session_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self._sessions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "appends": self.appends,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
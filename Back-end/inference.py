@@ -0,0 +1,239 @@
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Optional
+from dotenv import load_dotenv
+from llama_cpp import StoppingCriteriaList
+from model_registry import MODEL_POOL_SIZE
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Number of threads that run blocking llama.cpp work
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "4"))
+# Number of requests allowed to wait for a model before new ones are rejected
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", "16"))
+# Default per-request deadline in seconds (queue wait + inference)
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", "300"))
+
+_DONE = object()
+
+# Raised when the queue for a model is full; carries a Retry-After hint in seconds
+class QueueFullError(Exception):
+    def __init__(self, model: str, retry_after: int):
+        super().__init__(f"Too many requests waiting for model '{model}'")
+        self.model = model
+        self.retry_after = retry_after
+
+# Raised when a request could not finish before its deadline
+class DeadlineExceededError(Exception):
+    def __init__(self, model: str, retry_after: int):
+        super().__init__(f"Request for model '{model}' exceeded its deadline")
+        self.model = model
+        self.retry_after = retry_after
+
+# Raised when the client of a request went away and its work was abandoned
+class RequestCancelledError(Exception):
+    def __init__(self, model: str):
+        super().__init__(f"Request for model '{model}' was cancelled by the client")
+        self.model = model
+
+# Admission state for one model: a concurrency limit plus a bounded wait queue
+class ModelLane:
+    def __init__(self, name: str, concurrency: int, max_queue: int):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        # Requests whose in-flight work was aborted, by reason ("disconnect" or "deadline")
+        self.cancelled = {"disconnect": 0, "deadline": 0}
+        # Moving average of how long one slot is held, used for Retry-After
+        self.avg_service_time = 1.0
+
+    def retry_after(self) -> int:
+        return max(1, int(self.avg_service_time * (self.waiting + self.running) / self.concurrency))
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "cancelled": dict(self.cancelled),
+            "avg_service_time": round(self.avg_service_time, 3),
+        }
+
+# A held model slot; release() must be called exactly once.
+# The slot also carries the request's cancellation: once cancelled (or past its deadline)
+# decoding stops at the next token and the next pipeline stage raises instead of starting.
+class Slot:
+    def __init__(self, lane: ModelLane, deadline: float):
+        self.lane = lane
+        self.deadline = deadline
+        self.start = time.monotonic()
+        self.cancelled: Optional[str] = None
+        self._released = False
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    # Abort the request's work; only the first reason is kept and counted
+    def cancel(self, reason: str):
+        if self.cancelled is not None or self._released:
+            return
+        self.cancelled = reason
+        self.lane.cancelled[reason] += 1
+
+    # Polled by the decoding loops after every token
+    def should_stop(self) -> bool:
+        if self.cancelled is None and self.remaining() <= 0:
+            self.cancel("deadline")
+        return self.cancelled is not None
+
+    def raise_if_cancelled(self):
+        if not self.should_stop():
+            return
+        if self.cancelled == "deadline":
+            self.lane.timed_out += 1
+            raise DeadlineExceededError(self.lane.name, self.lane.retry_after())
+        raise RequestCancelledError(self.lane.name)
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        lane = self.lane
+        lane.running -= 1
+        lane.completed += 1
+        lane.avg_service_time = 0.8 * lane.avg_service_time + 0.2 * (time.monotonic() - self.start)
+        lane.semaphore.release()
+
+# Slot of the request the current inference thread works for, set by InferenceExecutor.call/iterate
+_current_slot: contextvars.ContextVar = contextvars.ContextVar("current_slot", default=None)
+
+def current_slot() -> Optional[Slot]:
+    return _current_slot.get()
+
+# Cancellation check of the current request for decoding loops, or None outside of a request
+def should_stop() -> Optional[Callable[[], bool]]:
+    slot = current_slot()
+    return slot.should_stop if slot is not None else None
+
+# Raise if the current request was cancelled, e.g. before caching a result its cancellation may have truncated
+def raise_if_cancelled():
+    slot = current_slot()
+    if slot is not None:
+        slot.raise_if_cancelled()
+
+# llama.cpp stopping criteria aborting the decode when the current request is cancelled
+def stopping_criteria() -> Optional[StoppingCriteriaList]:
+    slot = current_slot()
+    if slot is None:
+        return None
+    return StoppingCriteriaList([lambda input_ids, logits: slot.should_stop()])
+
+# Runs blocking inference on a dedicated thread pool so the event loop stays free
+class InferenceExecutor:
+    def __init__(self, workers: int = INFERENCE_WORKERS, max_queue: int = INFERENCE_MAX_QUEUE, timeout: float = INFERENCE_TIMEOUT):
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self._lanes: Dict[str, ModelLane] = {}
+
+    # Concurrency per model, e.g. INFERENCE_CONCURRENCY_CHAT=2 (defaults to the model pool size)
+    def lane(self, model: str) -> ModelLane:
+        if model not in self._lanes:
+            concurrency = int(os.getenv(f"INFERENCE_CONCURRENCY_{model.upper()}", str(MODEL_POOL_SIZE)))
+            self._lanes[model] = ModelLane(model, concurrency, self.max_queue)
+        return self._lanes[model]
+
+    # Override the concurrency of a model, e.g. when several requests can share one context
+    def configure(self, model: str, concurrency: int):
+        self._lanes[model] = ModelLane(model, concurrency, self.max_queue)
+
+    # Wait for a free slot on a model, rejecting immediately when the queue is full
+    async def acquire_slot(self, model: str = "chat", timeout: Optional[float] = None) -> Slot:
+        lane = self.lane(model)
+        deadline = time.monotonic() + (timeout or self.timeout)
+        if lane.semaphore.locked() and lane.waiting >= lane.max_queue:
+            lane.rejected += 1
+            raise QueueFullError(model, lane.retry_after())
+        lane.waiting += 1
+        try:
+            await asyncio.wait_for(lane.semaphore.acquire(), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            lane.timed_out += 1
+            raise DeadlineExceededError(model, lane.retry_after())
+        finally:
+            lane.waiting -= 1
+        lane.running += 1
+        return Slot(lane, deadline)
+
+    # Run a blocking function on the inference pool within an already held slot.
+    # The function sees the slot through current_slot(), so its decoding stops when the request is cancelled.
+    async def call(self, slot: Slot, fn, *args, **kwargs):
+        slot.raise_if_cancelled()
+        context = contextvars.copy_context()
+        context.run(_current_slot.set, slot)
+        future = asyncio.get_running_loop().run_in_executor(self._pool, partial(context.run, fn, *args, **kwargs))
+        try:
+            result = await asyncio.wait_for(future, slot.remaining())
+        except asyncio.TimeoutError:
+            slot.cancel("deadline")
+            slot.lane.timed_out += 1
+            raise DeadlineExceededError(slot.lane.name, slot.lane.retry_after())
+        except asyncio.CancelledError:
+            # The awaiting task went away (e.g. a streaming client disconnected)
+            slot.cancel("disconnect")
+            raise
+        # A decode stopped by the cancellation returns a truncated result, which must not be used
+        slot.raise_if_cancelled()
+        return result
+
+    # Run a blocking function on the inference pool under its own model slot
+    async def run(self, fn, *args, model: str = "chat", timeout: Optional[float] = None, **kwargs):
+        slot = await self.acquire_slot(model, timeout)
+        try:
+            return await self.call(slot, fn, *args, **kwargs)
+        finally:
+            slot.release()
+
+    # Drive a blocking iterator on the inference pool within an already held slot
+    async def iterate(self, slot: Slot, iterator):
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        context.run(_current_slot.set, slot)
+        try:
+            while True:
+                slot.raise_if_cancelled()
+                item = await loop.run_in_executor(self._pool, context.run, next, iterator, _DONE)
+                if item is _DONE:
+                    break
+                yield item
+            slot.raise_if_cancelled()
+        except (asyncio.CancelledError, GeneratorExit):
+            slot.cancel("disconnect")
+            raise
+        finally:
+            # Close the iterator on the pool so it releases its model handle
+            if hasattr(iterator, "close"):
+                await loop.run_in_executor(self._pool, iterator.close)
+
+    def stats(self) -> dict:
+        return {name: lane.stats() for name, lane in self._lanes.items()}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+executor = InferenceExecutor()
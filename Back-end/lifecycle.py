@@ -0,0 +1,80 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, Optional
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# When the models load: "background" (the server starts at once and is ready after loading),
+# "eager" (before the server accepts requests) or "lazy" (on the first request that needs them)
+MODEL_LOAD = os.getenv("MODEL_LOAD", "background")
+# Generate a few tokens once loaded, so the first request does not run on cold caches
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "1") == "1"
+MODEL_WARMUP_PROMPT = os.getenv("MODEL_WARMUP_PROMPT", "Suggest one IoT project idea.")
+MODEL_WARMUP_TOKENS = int(os.getenv("MODEL_WARMUP_TOKENS", "8"))
+
+# Startup state of the server for /healthz and /readyz, with the time of each startup phase
+class Lifecycle:
+    def __init__(self, mode: str = MODEL_LOAD):
+        if mode not in ("background", "eager", "lazy"):
+            raise ValueError(f"Unknown model loading mode: {mode}")
+        self.mode = mode
+        self.created_at = time.monotonic()
+        self.phases: Dict[str, float] = {}
+        self.phase: Optional[str] = None
+        self.started = False
+        self.loaded = False
+        self.error: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    # Time one phase of the startup and log it
+    @contextmanager
+    def timed(self, name: str):
+        self.phase = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - start, 3)
+            print(f"Startup phase '{name}' took {self.phases[name]:.2f}s")
+
+    # Load the models with `load()` unless they are loading or loaded; a failed load is retried on the next call
+    def load(self, load: Callable[[], Awaitable[None]]) -> asyncio.Task:
+        if self._task is None or (self._task.done() and not self.loaded):
+            self.error = None
+            self._task = asyncio.create_task(self._load(load))
+        return self._task
+
+    async def _load(self, load: Callable[[], Awaitable[None]]):
+        try:
+            await load()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            print(f"Model loading failed: {self.error}")
+            raise
+        finally:
+            self.phase = None
+        self.loaded = True
+        print(f"Ready {time.monotonic() - self.created_at:.2f}s after start")
+
+    # Ready for traffic: started, and loaded and warmed unless the models load on demand
+    @property
+    def ready(self) -> bool:
+        return self.started and (self.loaded or (self.mode == "lazy" and self.error is None))
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "started": self.started,
+            "loaded": self.loaded,
+            "ready": self.ready,
+            "phase": self.phase,
+            "error": self.error,
+            "uptime_seconds": round(time.monotonic() - self.created_at, 3),
+            "phases": dict(self.phases),
+        }
+
+lifecycle = Lifecycle()
@@ -1,339 +1,1164 @@
-import os
-from summarize import summarize
-from validation import validate
-from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from typing import List, Optional
-from sqlalchemy import create_engine, Column, Integer, String, Text, desc
-from sqlalchemy.orm import sessionmaker, declarative_base
-from llama_cpp import Llama, LlamaTokenizer
-from langfuse.decorators import langfuse_context, observe
-import langchain
-
-langchain.debug = True
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Get Langfuse environment variables
-Secret_Key = os.getenv("LANGFUSE_SECRET_KEY")
-Public_Key = os.getenv("LANGFUSE_PUBLIC_KEY")
-Host = os.getenv("LANGFUSE_HOST")
-
-langfuse_context.configure(
-    secret_key=Secret_Key,
-    public_key=Public_Key,
-    host=Host
-)
-
-# Define the FastAPI app
-app = FastAPI()
-
-# SQLite database setup using SQLAlchemy
-DATABASE_URL = "sqlite:///./chatbox.db"
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-# Conversation Model for the database
-class Chatbox(Base):
-    __tablename__ = "chatbox"
-    id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(String, index=True)
-    request = Column(Text, nullable=False)
-    response = Column(Text, nullable=False)
-    summarized_response = Column(Text, nullable=True)
-
-# Create the table if it doesn't exist
-Base.metadata.create_all(bind=engine)
-
-# Initialize llama.cpp model
-chat_model_path = os.getenv("MODEL_PATH")
-
-
-llama_model = Llama(model_path=chat_model_path,
-                    n_ctx=2048,
-                    n_batch=512,
-                    n_gpu_layers=-1,)
-
-# Initialize the tokenizer
-tokenizer = LlamaTokenizer(llama_model)
-
-# Define model role
-MODEL_ROLE = """You are an IoT project idea generator specializing in providing creative, practical, and achievable DIY IoT project ideas. \
-Give your suggestions based on the user's interests, experience level, available tools, and desired platforms (e.g., Raspberry Pi, Arduino, ESP32). \
-You must include a brief project description, a list of components, and potential use cases. \
-The ideas must be innovative, educational, or solve real-world problems. \
-You must be friendly, engaging, clear, and informative.
-"""
-
-# Define system prompt
-# Remove <|begin_of_text|>
-# RuntimeWarning: Detected duplicate leading "<|begin_of_text|>" in prompt, this will likely reduce response quality, consider removing it...
-# warnings.warn(
-SYSTEM_PROMPT = f"<|start_header_id|>system<|end_header_id|>\n\n{MODEL_ROLE}<|eot_id|>"
-
-# Define request and response Models
-class Request(BaseModel):
-    session_id: str
-    request: str
-    
-class Response(BaseModel):
-    session_id: str
-    request: str
-    response: str
-    summarized_response: Optional[str] = None
-    context: Optional[List[str]] = None
-
-class Summary(BaseModel):
-    request: str
-    summary: str
-    
-class SummaryRequest(BaseModel):
-    mode: str
-    request: str
-
-class NumHisCon(BaseModel):
-    num_conversations: int
-
-# Helper function to retrieve context from the database
-def get_conversation_context(db_session, session_id: str) -> List[str]:
-    chatbox = db_session.query(Chatbox).filter(Chatbox.session_id == session_id).order_by(desc(Chatbox.id)).limit(5).all()
-    #order_by(desc(Chatbox.id)): get the rows in descending order of id (the latest row is the last one)
-    #limit(5): get 5 rows
-    #reversed(chatbox): reverse the order of the rows (ensere the chronological order)
-    #chatbox = db_session.query(Chatbox).filter(Chatbox.session_id == session_id).all()
-    # Inside of the context, we have:
-    #<|start_header_id|>user<|end_header_id|>
-    #
-    #{User_Prompt_1}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
-    #
-    #{Model_Response_1}<|eot_id|><|start_header_id|>user<|end_header_id|>
-    # 
-    #{User_Prompt_2}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
-    # 
-    #{Model_Response_2}<|eot_id|><|start_header_id|>user<|end_header_id|>
-    #
-    #...
-    #
-    #{Model_Response_N-1}<|eot_id|><|start_header_id|>user<|end_header_id|>
-    # 
-    #{User_Prompt_N}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
-    #
-    #{Model_Response_N}<|eot_id|>
-    #
-    # Which mean: CONTEXT_PROMPT = 
-    #f"<|start_header_id|>user<|end_header_id|>\n\n{User_Prompt_1}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{Model_Response_1}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{User_Prompt_2}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{Model_Response_2}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n...\n\n{Model_Response_N-1}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{User_Prompt_N}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{Model_Response_N}<|eot_id|>"
-    # -> TOO LONG. Using loops to get data from database and put in context, we have:
-    # for chat in chatbox: (get user_prompt and response at every column in the 'chatbox' table - stored in the database)
-    #      CONTEXT_PROMPT += f"<|start_header_id|>user<|end_header_id|>\n\n{chat.user_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{chat.response}<|eot_id|>"
-    #
-    # if there is a summarized_response in the chatbox, we replace the response by the summarized_response
-    for chat in chatbox:
-        if chat.summarized_response != None:
-            chat.response = chat.summarized_response
-            
-    return [f"<|start_header_id|>user<|end_header_id|>\n\n{chat.request}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{chat.response}<|eot_id|>" for chat in reversed(chatbox)]
-
-@observe()
-@app.post("/summarize", response_model=Summary)
-async def summarize_text(request: SummaryRequest):
-    try:
-        summary = summarize(request.request, request.mode)
-        print(len(tokenizer.encode(summary, False)))
-        return Summary(
-            request=request.request,
-            summary=summary
-        )
-    
-    except Exception as e:
-        # General exception handling for unexpected errors
-        raise HTTPException(status_code=500, detail=str(e))
-
-@observe()    
-@app.post("/validation", response_model=Summary)
-async def validate_text(request: SummaryRequest):
-    try:
-        answer = validate(request.request)
-        #print(len(tokenizer.encode(answer, False)))
-        return Summary(
-            request=request.request,
-            summary=answer
-        )
-    
-    except Exception as e:
-        # General exception handling for unexpected errors
-        raise HTTPException(status_code=500, detail=str(e))
-
-# POST method to generate a response from the model
-@app.post("/generate-response", response_model=Response)
-@observe()
-async def generate_response(request: Request):
-    db_session = SessionLocal()
-    try:
-        # Define user prompt
-        USER_PROMPT = f"<|start_header_id|>user<|end_header_id|>\n\n{request.request}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
-        
-        # Retrieve previous context (if any in List[str]) for the session
-        context = get_conversation_context(db_session, request.session_id)
-        
-        # Summarize the user prompt if it is too long
-        if len(tokenizer.encode(f"{USER_PROMPT}", False)) > 64:
-            request.request = summarize(request.request, "input")
-            NEW_USER_PROMPT = f"<|start_header_id|>user<|end_header_id|>\n\n{request.request}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
-            full_prompt = f"{SYSTEM_PROMPT}{context}{NEW_USER_PROMPT}"
-        else:
-            full_prompt = f"{SYSTEM_PROMPT}{context}{USER_PROMPT}"
-        
-        # Combine system prompt with user 
-        #full_prompt = f"{SYSTEM_PROMPT}{context}{NEW_USER_PROMPT}"
-        #
-        #<|begin_of_text|><|start_header_id|>system<|end_header_id|>
-        #
-        #{SYSTEM_PROMPT}<|eot_id|>{CONTEXT AKA HISTORY OR SOMETHING LIKE THAT}<|start_header_id|>user<|end_header_id|>
-        #
-        #{prompt_request.user_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
-        #
-        #AKA:
-        #full_prompt = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{SYSTEM_PROMPT}<|eot_id|>{context}<|start_header_id|>user<|end_header_id|>\n\n{prompt_request.user_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
-        
-        # Generate the response using llama.cpp model with appropriate parameters
-        Bot_Response = llama_model(
-            prompt=full_prompt,
-            max_tokens=-1,       # The number of tokens to generate in the response, -1 for unlimited
-            temperature=0.5,      # The temperature for randomness, lower values are more deterministic
-            top_p=0.5            # The nucleus sampling probability
-        )
-        
-        # Extract the generated response
-        bot_answer = Bot_Response["choices"][0]["text"].strip()
-        # Check validation of the output
-        validation_result = validate(bot_answer)
-        
-        # If the output is not validated, return a message
-        if ("Not Validated" in validation_result) and ("Validated" not in validation_result):
-            print("Validation Result: ", validation_result)
-            return Response(
-                session_id=request.session_id,
-                request=request.request,
-                response="I'm sorry, but I'm unable to generate a valid response.",
-                summarized_response=None,
-                context=context
-            )
-        
-        # If the output is validated, begin checking the length of the response
-        else :
-            print("Validation Result: ", validation_result)
-            # Summarize the response if it is too long
-            if len(tokenizer.encode(f"{bot_answer}", False)) > 256:
-                summarized_bot_answer = summarize(bot_answer, "output")
-                
-                # Save the conversation in the database
-                new_chat = Chatbox(
-                    session_id=request.session_id,
-                    request=request.request,
-                    response=bot_answer,
-                    summarized_response=summarized_bot_answer
-                )
-                db_session.add(new_chat)
-                db_session.commit()
-                
-                # Return the model's response
-                print("Summarized Response: ", summarized_bot_answer)
-                return Response(
-                    session_id=request.session_id,
-                    request=request.request,
-                    response=bot_answer,
-                    summarized_response=summarized_bot_answer,
-                    context=context
-                )
-            
-            # If the response is not too long
-            else:
-                # Save the conversation in the database
-                new_chat = Chatbox(
-                    session_id=request.session_id,
-                    request=request.request,
-                    response=bot_answer,
-                    summarized_response=None
-                )
-                db_session.add(new_chat)
-                db_session.commit()
-                
-                # Return the model's response
-                print("Response: ", bot_answer)
-                return Response(
-                    session_id=request.session_id,
-                    request=request.request,
-                    response=bot_answer,
-                    summarized_response=None,
-                    context=context
-                )
-    
-    except Exception as e:
-        print(e)
-    finally:
-        db_session.close()
-
-@observe()
-# GET method to retrieve conversation history
-@app.get("/history/{session_id}", response_model= NumHisCon)
-def get_conversation_history(session_id: str):
-    db_session = SessionLocal()
-    try:
-        chatbox = db_session.query(Chatbox).filter(Chatbox.session_id == session_id).all()
-        return NumHisCon(
-            num_conversations=len(chatbox)
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db_session.close()
-
-@observe()
-# DELETE method to delete conversation history
-@app.delete("/delete-history/{session_id}")
-def delete_context(session_id: str):
-    db_session = SessionLocal()
-    try:
-        # Delete all conversations associated with the given session id
-        deleted_rows = db_session.query(Chatbox).filter(Chatbox.session_id == session_id).delete()
-
-        # Commit the transaction to make the change persistent
-        db_session.commit()
-
-        if deleted_rows == 0:
-            raise HTTPException(status_code=404, detail="No conversations found for the given session_id")
-        
-        return {"message": f"Deleted {deleted_rows} conversation(s) for session_id: {session_id}"}
-
-    except Exception as e:
-        db_session.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db_session.close()
-
-# Exception handler for invalid request format
-@app.exception_handler(RequestValidationError)
-async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    return JSONResponse(
-        status_code=422,
-        content={"detail": "Invalid request format. Please check the request body."}
-    )
-    
-#
-#"""
-#        return [
-#            Response(
-#                session_id=chat.session_id,
-#                user_prompt=chat.user_prompt,
-#                response=chat.response,
-#                summarized_response=chat.summarized_response,
-#                context=[]
-#            )
-#            for chat in chatbox
- #       ]
+import os
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from summarize import summarize, summarize_stream, fold_memory
+from validation import classify, Verdict
+from dotenv import load_dotenv
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+# The pydantic Request model below takes the name, the HTTP request is used for disconnect detection
+from starlette.requests import Request as HTTPRequest
+from pydantic import BaseModel
+from typing import List, Literal, Optional
+from sqlalchemy import select, delete, desc
+from sqlalchemy.exc import IntegrityError
+from database import SessionLocal, Chatbox, init_db, record_turn, update_session_stats, delete_session, get_session_stats, text_bytes, turns_query, get_session_memory, SessionMemory, session_tip, get_idempotency_record, IdempotencyRecord, IdempotencyKeyMismatchError, IDEMPOTENCY_TTL
+from model_registry import acquire, load_all, PoolTokenizer, stats as model_stats, MODEL_N_CTX
+from speculative import speculative, stats as speculative_stats
+from inference import executor, QueueFullError, DeadlineExceededError, RequestCancelledError, should_stop, stopping_criteria
+from scheduler import get_scheduler, SCHEDULER_SLOTS
+from prefix_cache import enable_prefix_cache, stats as prefix_cache_stats
+from summary_cache import summary_cache
+from summary_queue import SummaryQueue
+from semantic_cache import semantic_cache, context_key
+from context_cache import ContextCache, CachedTurn, SessionContext
+from structured_output import generate_structured, STRUCTURED_OUTPUT
+from coalesce import SingleFlight, request_key
+from session_memory import MemoryQueue, render_memory, SESSION_MEMORY, SESSION_MEMORY_TURNS, SESSION_MEMORY_MAX_FOLD
+from metrics import stage, llama_timings
+from batch import BatchRunner, resolve_batch_path, BATCH_CONCURRENCY
+from lifecycle import lifecycle, MODEL_WARMUP, MODEL_WARMUP_PROMPT, MODEL_WARMUP_TOKENS
+import metrics
+from tracing import observe, tracer, stats as tracing_stats
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Traces are sampled and exported in the background by tracing.py (TRACE_EXPORTER, TRACE_SAMPLE_RATE)
+
+# Startup and shutdown of the server, see startup() and shutdown()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup()
+    yield
+    await shutdown()
+
+# Define the FastAPI app
+app = FastAPI(lifespan=lifespan)
+
+http_request_seconds = metrics.histogram("http_request_seconds", "Time to answer an HTTP request (until the response starts for streams)")
+
+# The middleware below is a plain ASGI app rather than @app.middleware("http"): those wrap `receive`,
+# and behind them Request.is_disconnected() never sees the client leave (see watch_disconnect).
+
+# Time every request by route template, so path parameters do not create a series per session
+class RequestTimeMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        started = False
+
+        async def send_timed(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                observe_request(scope, start, message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        except BaseException:
+            if not started:
+                observe_request(scope, start, 500)
+            raise
+
+def observe_request(scope, start: float, status: int):
+    route = scope.get("route")
+    http_request_seconds.observe(
+        time.perf_counter() - start,
+        method=scope["method"],
+        path=route.path if route is not None else "unmatched",
+        status=str(status)
+    )
+
+# Route dependency of the endpoints that run a model: hold them back until the models are loaded.
+# With MODEL_LOAD=lazy the first one loads them, otherwise they are turned away with 503 so a load
+# balancer retries elsewhere. Database-only endpoints and the probes are answered meanwhile.
+async def require_models():
+    if lifecycle.loaded:
+        return
+    if lifecycle.mode == "lazy":
+        try:
+            await asyncio.shield(lifecycle.load(load_models))
+        except Exception:
+            raise HTTPException(status_code=503, detail=f"Model loading failed: {lifecycle.error}")
+        return
+    detail = f"Model loading failed: {lifecycle.error}" if lifecycle.error else "Model is loading"
+    raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+
+app.add_middleware(RequestTimeMiddleware)
+
+# Tokenizer of the llama.cpp chat model (shared with summarize.py and validation.py through the registry)
+tokenizer = PoolTokenizer("chat")
+
+# Continuous-batching scheduler for the chat model, created once the model is loaded (None unless SCHEDULER_SLOTS > 0)
+batch_scheduler = None
+if SCHEDULER_SLOTS > 0:
+    executor.configure("chat", SCHEDULER_SLOTS)
+
+# Define model role
+MODEL_ROLE = """You are an IoT project idea generator specializing in providing creative, practical, and achievable DIY IoT project ideas. \
+Give your suggestions based on the user's interests, experience level, available tools, and desired platforms (e.g., Raspberry Pi, Arduino, ESP32). \
+You must include a brief project description, a list of components, and potential use cases. \
+The ideas must be innovative, educational, or solve real-world problems. \
+You must be friendly, engaging, clear, and informative.
+"""
+
+# Define system prompt
+# Remove <|begin_of_text|>
+# RuntimeWarning: Detected duplicate leading "<|begin_of_text|>" in prompt, this will likely reduce response quality, consider removing it...
+# warnings.warn(
+SYSTEM_PROMPT = f"<|start_header_id|>system<|end_header_id|>\n\n{MODEL_ROLE}<|eot_id|>"
+
+# Snapshot the llama.cpp state after the system prompt so it is never prefilled twice
+enable_prefix_cache("chat", [SYSTEM_PROMPT])
+
+# Token budget of the prompt: n_ctx minus the system prompt and the tokens reserved for the answer.
+# The system prompt is counted by load_models() once the tokenizer is loaded; requests wait for it.
+SYSTEM_PROMPT_TOKENS = 0
+RESERVED_OUTPUT_TOKENS = int(os.getenv("RESERVED_OUTPUT_TOKENS", "512"))
+CONTEXT_BUDGET = MODEL_N_CTX - RESERVED_OUTPUT_TOKENS
+# Most turns considered for the context, newest first
+MAX_CONTEXT_TURNS = int(os.getenv("MAX_CONTEXT_TURNS", "20"))
+# "\n\n" and <|eot_id|> added after the response when a turn is rendered
+TURN_OVERHEAD_TOKENS = 2
+
+# Define request and response Models
+class Request(BaseModel):
+    session_id: str
+    request: str
+    
+class Response(BaseModel):
+    id: Optional[int] = None
+    session_id: str
+    request: str
+    response: str
+    summarized_response: Optional[str] = None
+    context: Optional[List[str]] = None
+    validated: Optional[bool] = None
+    summary_job_id: Optional[str] = None
+
+class Summary(BaseModel):
+    request: str
+    summary: str
+    confidence: Optional[float] = None
+    
+class SummaryRequest(BaseModel):
+    mode: str
+    request: str
+
+class NumHisCon(BaseModel):
+    num_conversations: int
+
+class Turn(BaseModel):
+    id: int
+    request: str
+    response: Optional[str] = None
+    summarized_response: Optional[str] = None
+
+class TurnsPage(BaseModel):
+    session_id: str
+    turns: List[Turn]
+    # Pass as `after` to get the next page, None on the last page
+    next_cursor: Optional[int] = None
+
+class SessionStatsResponse(BaseModel):
+    session_id: str
+    turn_count: int
+    total_tokens: int
+    bytes_stored: int
+    created_at: float
+    last_activity: float
+
+# Render one conversation turn as it appears in the prompt
+def render_turn(request: str, response: str) -> str:
+    return f"<|start_header_id|>user<|end_header_id|>\n\n{request}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{response}<|eot_id|>"
+
+# Count the tokens of a rendered turn
+def count_turn_tokens(request: str, response: str) -> int:
+    return len(tokenizer.encode(render_turn(request, response), False))
+
+# Newest turns of the active sessions, already rendered, so a hot session's prompt needs no database read
+context_cache = ContextCache(MAX_CONTEXT_TURNS)
+# Check a cached context against the newest turn in the database before using it. Needed behind supervisor.py
+# (on by default there): a session that moved to another replica and back was written past this replica's cache.
+CONTEXT_CACHE_VERIFY = os.getenv("CONTEXT_CACHE_VERIFY", "1" if os.getenv("REPLICA_INDEX") else "0") == "1"
+
+# Render a saved row in both of its prompt forms
+def cached_turn(chat: Chatbox) -> CachedTurn:
+    summarized = None
+    if chat.summarized_response is not None:
+        summarized = render_turn(chat.request, chat.summarized_response)
+    return CachedTurn(chat.id, render_turn(chat.request, chat.response), chat.token_count, summarized, chat.summarized_token_count)
+
+# Render the rolling memory of a session, or None when it has none
+def cached_memory(memory: Optional[SessionMemory]) -> Optional[CachedTurn]:
+    if memory is None:
+        return None
+    return CachedTurn(memory.folded_through_id, render_memory(memory.summary), memory.token_count)
+
+# Load the context of a session from the database: its memory and the newest turns not folded into it, oldest first
+async def load_context(db_session, session_id: str) -> SessionContext:
+    memory = await get_session_memory(db_session, session_id) if SESSION_MEMORY else None
+    folded_through_id = memory.folded_through_id if memory is not None else 0
+    result = await db_session.execute(
+        select(Chatbox)
+        .where(Chatbox.session_id == session_id, Chatbox.id > folded_through_id)
+        .order_by(desc(Chatbox.id))
+        .limit(MAX_CONTEXT_TURNS)
+    )
+    chatbox = result.scalars().all()
+    #order_by(desc(Chatbox.id)): get the rows in descending order of id (the latest row is the last one)
+    #limit(MAX_CONTEXT_TURNS): get at most MAX_CONTEXT_TURNS rows, the budget decides how many are used
+    #reversed(chatbox): reverse the order of the rows (ensere the chronological order)
+    #chatbox = db_session.query(Chatbox).filter(Chatbox.session_id == session_id).all()
+    # Inside of the context, we have:
+    #<|start_header_id|>user<|end_header_id|>
+    #
+    #{User_Prompt_1}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+    #
+    #{Model_Response_1}<|eot_id|><|start_header_id|>user<|end_header_id|>
+    # 
+    #{User_Prompt_2}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+    # 
+    #{Model_Response_2}<|eot_id|><|start_header_id|>user<|end_header_id|>
+    #
+    #...
+    #
+    #{Model_Response_N-1}<|eot_id|><|start_header_id|>user<|end_header_id|>
+    # 
+    #{User_Prompt_N}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+    #
+    #{Model_Response_N}<|eot_id|>
+    #
+    # Which mean: CONTEXT_PROMPT = 
+    #f"<|start_header_id|>user<|end_header_id|>\n\n{User_Prompt_1}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{Model_Response_1}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{User_Prompt_2}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{Model_Response_2}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n...\n\n{Model_Response_N-1}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{User_Prompt_N}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{Model_Response_N}<|eot_id|>"
+    # -> TOO LONG. Using loops to get data from database and put in context, we have:
+    # for chat in chatbox: (get user_prompt and response at every column in the 'chatbox' table - stored in the database)
+    #      CONTEXT_PROMPT += f"<|start_header_id|>user<|end_header_id|>\n\n{chat.user_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n{chat.response}<|eot_id|>"
+    #
+    # Rows written before token counts were stored are counted once and backfilled
+    backfilled = False
+    for chat in chatbox:
+        if chat.token_count is None:
+            chat.token_count = count_turn_tokens(chat.request, chat.response)
+            # Sessions counted before token counts existed did not include this turn's tokens
+            await update_session_stats(db_session, session_id, tokens=chat.token_count)
+            backfilled = True
+        if chat.summarized_response is not None and chat.summarized_token_count is None:
+            chat.summarized_token_count = count_turn_tokens(chat.request, chat.summarized_response)
+            backfilled = True
+    if backfilled:
+        await db_session.commit()
+    
+    return SessionContext([cached_turn(chat) for chat in reversed(chatbox)], cached_memory(memory))
+
+# Helper function to retrieve context, from the context cache or else the database.
+# The session's rolling memory (when it has one) comes first and covers every turn folded into it.
+# Packs the newest remaining turns into `budget` tokens using the token counts stored with each row:
+# first every turn in its cheapest form (summarized when available), newest first,
+# then turns are upgraded to their full response while the budget allows.
+async def get_conversation_context(db_session, session_id: str, budget: int) -> List[str]:
+    entry, seq = context_cache.get(session_id)
+    if entry is not None and CONTEXT_CACHE_VERIFY and entry.tip != await session_tip(db_session, session_id):
+        # Written elsewhere since it was cached
+        context_cache.invalidate(session_id)
+        entry, seq = context_cache.get(session_id)
+    if entry is None:
+        entry = await load_context(db_session, session_id)
+        context_cache.put(session_id, entry, seq)
+    
+    memory = entry.memory
+    turns = entry.turns
+    if memory is not None and memory.full_tokens <= budget:
+        budget -= memory.full_tokens
+        # Turns the memory already covers are not repeated
+        turns = [turn for turn in turns if turn.id > memory.id]
+    else:
+        memory = None
+    
+    # If there is a summarized form of the turn, start from it.
+    # Rows whose summary is still queued use the full response until it arrives.
+    chosen = []
+    used = 0
+    for turn in reversed(turns):
+        summarized = turn.summarized is not None
+        cost = turn.summarized_tokens if summarized else turn.full_tokens
+        if used + cost > budget:
+            break
+        chosen.append([turn, not summarized])
+        used += cost
+    
+    # Spend what is left of the budget on full responses, newest first
+    for item in chosen:
+        turn, full = item
+        if not full:
+            extra = turn.full_tokens - turn.summarized_tokens
+            if used + extra <= budget:
+                item[1] = True
+                used += extra
+    
+    context = [turn.full if full else turn.summarized for turn, full in reversed(chosen)]
+    if memory is not None:
+        context.insert(0, memory.full)
+    return context
+
+# Event loop of the server, set on startup so worker threads can schedule database writes on it
+event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# Store a summary produced in the background on its conversation row
+async def store_summary(row_id: int, summary: str):
+    async with SessionLocal() as db_session:
+        chat = await db_session.get(Chatbox, row_id)
+        # The history may have been deleted while the job was queued
+        if chat is None:
+            return
+        chat.summarized_response = summary
+        chat.summarized_token_count = count_turn_tokens(chat.request, summary)
+        await update_session_stats(db_session, chat.session_id, size=text_bytes(summary))
+        await db_session.commit()
+        context_cache.update(chat.session_id, row_id, lambda turn: cached_turn(chat))
+
+# Run a coroutine on the server's event loop from a worker thread and wait for its result
+def run_on_loop(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, event_loop).result()
+
+# Called on a summary worker thread; the write itself runs on the server's event loop
+def save_deferred_summary(job, summary: str):
+    run_on_loop(store_summary(job.row_id, summary))
+    if semantic_cache is not None:
+        semantic_cache.add_summary(job.text, summary)
+
+# Memory of a session and its newest turns not folded into it yet, oldest first, as plain tuples
+async def load_unfolded_turns(session_id: str):
+    async with SessionLocal() as db_session:
+        memory = await get_session_memory(db_session, session_id)
+        folded_through_id = memory.folded_through_id if memory is not None else 0
+        result = await db_session.execute(
+            select(Chatbox.id, Chatbox.request, Chatbox.response, Chatbox.summarized_response)
+            .where(Chatbox.session_id == session_id, Chatbox.id > folded_through_id)
+            .order_by(desc(Chatbox.id))
+            .limit(SESSION_MEMORY_TURNS + SESSION_MEMORY_MAX_FOLD)
+        )
+        return (memory.summary if memory is not None else ""), list(reversed(result.all()))
+
+# Save the memory of a session, unless its history was deleted while it was being folded
+async def store_memory(session_id: str, summary: str, token_count: int, folded_through_id: int):
+    async with SessionLocal() as db_session:
+        if await db_session.get(Chatbox, folded_through_id) is None:
+            return
+        memory = await get_session_memory(db_session, session_id)
+        if memory is None:
+            memory = SessionMemory(session_id=session_id)
+            db_session.add(memory)
+        memory.summary = summary
+        memory.token_count = token_count
+        memory.folded_through_id = folded_through_id
+        memory.updated_at = time.time()
+        await db_session.commit()
+        context_cache.set_memory(session_id, cached_memory(memory))
+
+# Fold the turns of a session that fell out of the window into its memory, one turn at a time.
+# Runs on the memory worker thread; returns the number of turns folded.
+def fold_session(session_id: str) -> int:
+    summary, turns = run_on_loop(load_unfolded_turns(session_id))
+    fold = turns[:-SESSION_MEMORY_TURNS] if SESSION_MEMORY_TURNS > 0 else turns
+    if not fold:
+        return 0
+    for turn_id, request, response, summarized_response in fold:
+        summary = fold_memory(summary, request, summarized_response or response)
+    token_count = len(tokenizer.encode(render_memory(summary), False))
+    run_on_loop(store_memory(session_id, summary, token_count, fold[-1][0]))
+    return len(fold)
+
+# Rolling session memory, folded in the background (None unless SESSION_MEMORY=1)
+memory_queue = MemoryQueue(fold_session) if SESSION_MEMORY else None
+
+# Keep the in-memory state of a session current after one of its turns is committed
+def turn_saved(chat: Chatbox):
+    context_cache.append(chat.session_id, cached_turn(chat))
+    if memory_queue is not None:
+        memory_queue.submit(chat.session_id)
+
+# Commit a new turn and return the response for it. With an idempotency key the response is stored
+# in the same transaction; if another request with that key committed first (e.g. on another
+# replica), nothing is written and its stored response is returned instead.
+# Returns the response and whether this turn was saved.
+async def commit_turn(db_session, new_chat: Chatbox, make_response, idempotency_key: Optional[str] = None):
+    db_session.add(new_chat)
+    await record_turn(db_session, new_chat)
+    await db_session.flush()
+    response = make_response(new_chat)
+    if idempotency_key is not None:
+        await db_session.execute(
+            delete(IdempotencyRecord).where(IdempotencyRecord.key == idempotency_key, IdempotencyRecord.created_at < time.time() - IDEMPOTENCY_TTL)
+        )
+        db_session.add(IdempotencyRecord(
+            key=idempotency_key,
+            session_id=new_chat.session_id,
+            chatbox_id=new_chat.id,
+            request_hash=request_key(new_chat.request),
+            response=json.dumps(response.dict()),
+            created_at=time.time()
+        ))
+    try:
+        with stage("db_commit"):
+            await db_session.commit()
+    except IntegrityError:
+        await db_session.rollback()
+        record = None
+        if idempotency_key is not None:
+            record = await get_idempotency_record(db_session, idempotency_key, new_chat.session_id, request_key(new_chat.request))
+        if record is None:
+            raise
+        return Response(**json.loads(record.response)), False
+    turn_saved(new_chat)
+    return response, True
+
+# Seconds between two checks for a disconnected client
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+# Largest page of /sessions/{id}/turns, and rows read per query of an NDJSON export
+TURNS_PAGE_LIMIT = int(os.getenv("TURNS_PAGE_LIMIT", "1000"))
+TURNS_EXPORT_BATCH = int(os.getenv("TURNS_EXPORT_BATCH", "500"))
+
+# Summarize long answers after the response is returned (set DEFERRED_SUMMARY=0 to summarize inline)
+DEFERRED_SUMMARY = os.getenv("DEFERRED_SUMMARY", "1") == "1"
+SUMMARY_DRAIN_TIMEOUT = float(os.getenv("SUMMARY_DRAIN_TIMEOUT", "60"))
+TRACE_DRAIN_TIMEOUT = float(os.getenv("TRACE_DRAIN_TIMEOUT", "10"))
+summary_queue = SummaryQueue(summarize, save_deferred_summary)
+
+# Concurrent identical requests share one in-flight computation
+generate_flight = SingleFlight("generate", retry_on=(RequestCancelledError,))
+summarize_flight = SingleFlight("summarize")
+validation_flight = SingleFlight("validation")
+
+@app.post("/summarize", response_model=Summary, dependencies=[Depends(require_models)])
+@observe()
+async def summarize_text(request: SummaryRequest):
+    try:
+        summary = await summarize_flight.do(
+            request_key(request.mode, request.request),
+            lambda: executor.run(summarize, request.request, request.mode)
+        )
+        print(len(tokenizer.encode(summary, False)))
+        return Summary(
+            request=request.request,
+            summary=summary
+        )
+    
+    except (QueueFullError, DeadlineExceededError):
+        raise
+    except Exception as e:
+        # General exception handling for unexpected errors
+        raise HTTPException(status_code=500, detail=str(e))
+
+# POST method to summarize a text of any length over Server-Sent Events.
+# Long texts are split into chunks summarized in parallel, then reduced level by level;
+# each partial summary is sent as a "map" or "reduce" event, and the result as a "done" event.
+@app.post("/summarize/stream", dependencies=[Depends(require_models)])
+async def summarize_text_stream(request: SummaryRequest):
+    slot = await executor.acquire_slot("chat")
+    
+    async def event_stream():
+        try:
+            async for event in executor.iterate(slot, summarize_stream(request.request, request.mode)):
+                yield sse_event(event["stage"], event)
+        except Exception as e:
+            print(e)
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            slot.release()
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/validation", response_model=Summary, dependencies=[Depends(require_models)])
+@observe()
+async def validate_text(request: SummaryRequest):
+    try:
+        verdict = await validation_flight.do(request_key(request.request), lambda: executor.run(classify, request.request))
+        return Summary(
+            request=request.request,
+            summary=verdict.label,
+            confidence=verdict.confidence
+        )
+    
+    except (QueueFullError, DeadlineExceededError):
+        raise
+    except Exception as e:
+        # General exception handling for unexpected errors
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Build the full prompt for a request, summarizing the user prompt if it is too long.
+# Returns the prompt, the context turns and the token count of the user turn.
+# Blocking model calls run on the inference pool within the request's slot.
+async def build_prompt(db_session, request: Request, slot):
+    # Define user prompt
+    USER_PROMPT = f"<|start_header_id|>user<|end_header_id|>\n\n{request.request}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
+    prompt_tokens = len(tokenizer.encode(f"{USER_PROMPT}", False))
+    
+    # Summarize the user prompt if it is too long
+    if prompt_tokens > 64:
+        with stage("input_summary"):
+            request.request = await executor.call(slot, summarize, request.request, "input")
+        USER_PROMPT = f"<|start_header_id|>user<|end_header_id|>\n\n{request.request}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
+        prompt_tokens = len(tokenizer.encode(f"{USER_PROMPT}", False))
+    
+    # Retrieve previous context (if any in List[str]) for the session, within what is left of the budget
+    with stage("context"):
+        context = await get_conversation_context(db_session, request.session_id, CONTEXT_BUDGET - prompt_tokens)
+    full_prompt = f"{SYSTEM_PROMPT}{''.join(context)}{USER_PROMPT}"
+    
+    # Combine system prompt with user 
+    #full_prompt = f"{SYSTEM_PROMPT}{context}{NEW_USER_PROMPT}"
+    #
+    #<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+    #
+    #{SYSTEM_PROMPT}<|eot_id|>{CONTEXT AKA HISTORY OR SOMETHING LIKE THAT}<|start_header_id|>user<|end_header_id|>
+    #
+    #{prompt_request.user_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+    #
+    #AKA:
+    #full_prompt = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{SYSTEM_PROMPT}<|eot_id|>{context}<|start_header_id|>user<|end_header_id|>\n\n{prompt_request.user_prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
+    return full_prompt, context, prompt_tokens
+
+# Validate the generated answer, summarize it if it is too long and save the conversation
+# `summary` and `verdict` are passed when the structured decode already produced them.
+async def finish_response(db_session, request: Request, bot_answer: str, context: List[str], prompt_tokens: int, slot,
+                          answer_tokens: Optional[int] = None, summary: Optional[str] = None, verdict: Optional[Verdict] = None,
+                          idempotency_key: Optional[str] = None) -> Response:
+    # Check validation of the output
+    if verdict is None:
+        with stage("validate"):
+            verdict = await executor.call(slot, classify, bot_answer)
+    print("Validation Result: ", verdict.label, verdict.confidence, verdict.stage)
+    
+    # If the output is not validated, return a message
+    if not verdict.validated:
+        return Response(
+            session_id=request.session_id,
+            request=request.request,
+            response="I'm sorry, but I'm unable to generate a valid response.",
+            summarized_response=None,
+            context=context,
+            validated=False
+        )
+    
+    # If the output is validated, summarize the response if it is too long
+    if answer_tokens is None:
+        answer_tokens = len(tokenizer.encode(f"{bot_answer}", False))
+    summarized_bot_answer = None
+    summarized_token_count = None
+    needs_summary = answer_tokens > 256
+    if needs_summary and summary is not None:
+        # Written by the structured decode together with the answer
+        summarized_bot_answer = summary
+        summarized_token_count = prompt_tokens + len(tokenizer.encode(f"{summarized_bot_answer}", False)) + TURN_OVERHEAD_TOKENS
+        print("Summarized Response (structured): ", summarized_bot_answer)
+    elif needs_summary and DEFERRED_SUMMARY:
+        # Only the next turn's context needs the summary, it is filled in by summary_queue
+        print("Response (summary deferred): ", bot_answer)
+    elif needs_summary:
+        with stage("output_summary"):
+            summarized_bot_answer = await executor.call(slot, summarize, bot_answer, "output")
+        summarized_token_count = prompt_tokens + len(tokenizer.encode(f"{summarized_bot_answer}", False)) + TURN_OVERHEAD_TOKENS
+        print("Summarized Response: ", summarized_bot_answer)
+    else:
+        print("Response: ", bot_answer)
+    
+    # A cancelled turn is not persisted
+    slot.raise_if_cancelled()
+    
+    # Save the conversation in the database, with token counts so the context never re-tokenizes it
+    new_chat = Chatbox(
+        session_id=request.session_id,
+        request=request.request,
+        response=bot_answer,
+        summarized_response=summarized_bot_answer,
+        token_count=prompt_tokens + answer_tokens + TURN_OVERHEAD_TOKENS,
+        summarized_token_count=summarized_token_count
+    )
+    response, saved = await commit_turn(db_session, new_chat, lambda chat: Response(
+        id=chat.id,
+        session_id=request.session_id,
+        request=request.request,
+        response=bot_answer,
+        summarized_response=summarized_bot_answer,
+        context=context,
+        validated=True
+    ), idempotency_key)
+    
+    if saved and needs_summary and summarized_bot_answer is None:
+        response.summary_job_id = summary_queue.submit(new_chat.id, bot_answer, "output").id
+    
+    # Return the model's response
+    return response
+
+# Look up a validated answer to a near-duplicate request (only when SEMANTIC_CACHE=1).
+# Returns the cached entry (or None) and the request embedding to store the new answer under.
+async def lookup_cached_answer(request: Request, context: List[str], slot):
+    if semantic_cache is None:
+        return None, None
+    vector = await executor.call(slot, semantic_cache.embed, request.request)
+    return semantic_cache.lookup(vector, context_key(context)), vector
+
+# Save a turn answered from the semantic cache and return it
+async def save_cached_answer(db_session, request: Request, entry: dict, context: List[str], prompt_tokens: int,
+                             idempotency_key: Optional[str] = None) -> Response:
+    summarized_token_count = None
+    if entry["summarized_response"] is not None:
+        summarized_token_count = prompt_tokens + len(tokenizer.encode(entry["summarized_response"], False)) + TURN_OVERHEAD_TOKENS
+    answer_tokens = len(tokenizer.encode(entry["response"], False))
+    new_chat = Chatbox(
+        session_id=request.session_id,
+        request=request.request,
+        response=entry["response"],
+        summarized_response=entry["summarized_response"],
+        token_count=prompt_tokens + answer_tokens + TURN_OVERHEAD_TOKENS,
+        summarized_token_count=summarized_token_count
+    )
+    response, saved = await commit_turn(db_session, new_chat, lambda chat: Response(
+        id=chat.id,
+        session_id=request.session_id,
+        request=request.request,
+        response=entry["response"],
+        summarized_response=entry["summarized_response"],
+        context=context,
+        validated=True
+    ), idempotency_key)
+    # Cached before its deferred summary was ready: this row gets its own summary job
+    if saved and answer_tokens > 256 and entry["summarized_response"] is None:
+        response.summary_job_id = summary_queue.submit(new_chat.id, entry["response"], "output").id
+    return response
+
+# Remember a validated answer for near-duplicate requests
+def remember_answer(vector, context: List[str], response: Response):
+    if vector is not None and response.validated:
+        semantic_cache.add(vector, context_key(context), response.request, response.response, response.summarized_response)
+        # A deferred summary that finished before the answer was cached is filled in here, later ones by save_deferred_summary
+        job = summary_queue.get(response.summary_job_id) if response.summary_job_id else None
+        if job is not None and job.summary is not None:
+            semantic_cache.add_summary(response.response, job.summary)
+
+# Generate the answer for a full prompt (blocking, called on the inference pool)
+def generate_text(full_prompt: str) -> dict:
+    if batch_scheduler is not None:
+        # Decoded together with the other sessions' sequences
+        return batch_scheduler.generate(full_prompt, max_tokens=-1, temperature=0.5, top_p=0.5, should_stop=should_stop())
+    with acquire("chat") as model, speculative(model, "chat"), llama_timings(model.llama, "chat"):
+        return model.llama(
+            prompt=full_prompt,
+            max_tokens=-1,       # The number of tokens to generate in the response, -1 for unlimited
+            temperature=0.5,      # The temperature for randomness, lower values are more deterministic
+            top_p=0.5,           # The nucleus sampling probability
+            stopping_criteria=stopping_criteria()  # Stops decoding when the request is cancelled
+        )
+
+# Per-request deadline in seconds from the X-Request-Timeout header (INFERENCE_TIMEOUT when absent)
+def request_timeout(http_request: HTTPRequest) -> Optional[float]:
+    value = http_request.headers.get("x-request-timeout")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="X-Request-Timeout must be a number of seconds")
+
+# Cancel the request's work as soon as its client disconnects
+async def watch_disconnect(http_request: HTTPRequest, slot):
+    while not slot.should_stop():
+        if await http_request.is_disconnected():
+            slot.cancel("disconnect")
+            return
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+# POST method to generate a response from the model.
+# Identical concurrent requests on the same conversation state are answered by one generation,
+# and an Idempotency-Key header makes retries return the first response instead of adding a turn.
+@app.post("/generate-response", response_model=Response, dependencies=[Depends(require_models)])
+@observe()
+async def generate_response(request: Request, http_request: HTTPRequest):
+    idempotency_key = http_request.headers.get("idempotency-key")
+    if idempotency_key:
+        # A retry of a finished request gets the stored response
+        async with SessionLocal() as db_session:
+            record = await get_idempotency_record(db_session, idempotency_key, request.session_id, request_key(request.request))
+        if record is not None:
+            return Response(**json.loads(record.response))
+        # Another session reusing the key does not share this computation, its commit is refused
+        key = request_key("idempotency", idempotency_key, request.session_id, request.request)
+    else:
+        # The newest turn identifies the conversation state; hot sessions have it in the context cache
+        tip = None if CONTEXT_CACHE_VERIFY else context_cache.tip(request.session_id)
+        if tip is None:
+            async with SessionLocal() as db_session:
+                tip = await session_tip(db_session, request.session_id)
+        key = request_key("generate", request.session_id, tip, request.request)
+    return await generate_flight.do(key, lambda: generate_pipeline(request, http_request, idempotency_key))
+
+# The generation pipeline of one /generate-response computation
+async def generate_pipeline(request: Request, http_request: HTTPRequest, idempotency_key: Optional[str] = None) -> Response:
+    # Admit the request; its blocking stages then run on the inference pool so other endpoints stay responsive
+    slot = await executor.acquire_slot("chat", request_timeout(http_request))
+    watcher = asyncio.create_task(watch_disconnect(http_request, slot))
+    try:
+        return await run_pipeline(request, slot, idempotency_key)
+    except (QueueFullError, DeadlineExceededError, RequestCancelledError, IdempotencyKeyMismatchError):
+        raise
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        watcher.cancel()
+        slot.release()
+
+# Answer a request within a held slot: prompt, semantic cache or generation, validation, summary and commit.
+# Shared by /generate-response and the batch jobs.
+async def run_pipeline(request: Request, slot, idempotency_key: Optional[str] = None) -> Response:
+    async with SessionLocal() as db_session:
+        full_prompt, context, prompt_tokens = await build_prompt(db_session, request, slot)
+        
+        # Serve near-duplicate requests from the semantic cache
+        cached, vector = await lookup_cached_answer(request, context, slot)
+        if cached is not None:
+            return await save_cached_answer(db_session, request, cached, context, prompt_tokens, idempotency_key)
+        
+        if STRUCTURED_OUTPUT:
+            # One constrained decode yields the answer with its summary (and label)
+            with stage("generate", mode="structured"):
+                structured = await executor.call(slot, generate_structured, full_prompt)
+            response = await finish_response(db_session, request, structured.answer, context, prompt_tokens, slot,
+                                             summary=structured.summary, verdict=structured.verdict, idempotency_key=idempotency_key)
+            await executor.call(slot, remember_answer, vector, context, response)
+            return response
+        
+        # Generate the response using llama.cpp model with appropriate parameters
+        with stage("generate", mode="text"):
+            Bot_Response = await executor.call(slot, generate_text, full_prompt)
+        
+        # Extract the generated response
+        bot_answer = Bot_Response["choices"][0]["text"].strip()
+        answer_tokens = Bot_Response["usage"]["completion_tokens"]
+        response = await finish_response(db_session, request, bot_answer, context, prompt_tokens, slot, answer_tokens,
+                                         idempotency_key=idempotency_key)
+        await executor.call(slot, remember_answer, vector, context, response)
+        return response
+
+# Answer one record of a batch job. Batch records take at most BATCH_CONCURRENCY chat slots
+# and wait out a full queue instead of failing, so interactive requests keep the rest.
+async def generate_batch_record(record: dict, idempotency_key: str) -> dict:
+    request = Request(**record)
+    # A record answered before the job was interrupted gets its stored response
+    async with SessionLocal() as db_session:
+        stored = await get_idempotency_record(db_session, idempotency_key, request.session_id, request_key(request.request))
+    if stored is not None:
+        return json.loads(stored.response)
+    while True:
+        try:
+            slot = await executor.acquire_slot("chat")
+            break
+        except QueueFullError as e:
+            await asyncio.sleep(e.retry_after)
+    try:
+        response = await run_pipeline(request, slot, idempotency_key)
+    finally:
+        slot.release()
+    return response.dict()
+
+# Batch records never take the last chat slot, which stays for interactive requests. The scheduler path
+# decodes each record from its full prompt: the prefix cache only serves the per-request Llama path.
+batch_runner = BatchRunner(generate_batch_record, min(BATCH_CONCURRENCY or executor.lane("chat").concurrency, executor.lane("chat").concurrency - 1))
+
+# Yield the generated text piece by piece, through the batch scheduler when enabled
+def stream_tokens(full_prompt: str):
+    if batch_scheduler is not None:
+        yield from batch_scheduler.stream(full_prompt, max_tokens=-1, temperature=0.5, top_p=0.5, should_stop=should_stop())
+        return
+    with acquire("chat") as model, speculative(model, "chat"), llama_timings(model.llama, "chat"):
+        for chunk in model.llama(
+            prompt=full_prompt,
+            max_tokens=-1,
+            temperature=0.5,
+            top_p=0.5,
+            stream=True,
+            stopping_criteria=stopping_criteria()
+        ):
+            yield chunk["choices"][0]["text"]
+
+# Format one Server-Sent Event
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# POST method to stream the response token by token over Server-Sent Events.
+# Emits "token" events while decoding, then one "done" event carrying the same
+# fields as /generate-response (validation result, summary and saved row id).
+@app.post("/generate-response/stream", dependencies=[Depends(require_models)])
+async def generate_response_stream(request: Request, http_request: HTTPRequest):
+    # Admit the request before the response starts so overload still returns 429
+    slot = await executor.acquire_slot("chat", request_timeout(http_request))
+    
+    async def event_stream():
+        watcher = asyncio.create_task(watch_disconnect(http_request, slot))
+        try:
+            async with SessionLocal() as db_session:
+                full_prompt, context, prompt_tokens = await build_prompt(db_session, request, slot)
+                
+                # A cached answer is sent as a single token event
+                cached, vector = await lookup_cached_answer(request, context, slot)
+                if cached is not None:
+                    response = await save_cached_answer(db_session, request, cached, context, prompt_tokens)
+                    yield sse_event("token", {"text": response.response})
+                    yield sse_event("done", response.dict())
+                    return
+                
+                # Stream the chunks as llama.cpp decodes them, on the inference pool
+                chunks = []
+                with stage("generate", mode="stream"):
+                    async for text in executor.iterate(slot, stream_tokens(full_prompt)):
+                        if text:
+                            chunks.append(text)
+                            yield sse_event("token", {"text": text})
+                
+                bot_answer = "".join(chunks).strip()
+                response = await finish_response(db_session, request, bot_answer, context, prompt_tokens, slot)
+                await executor.call(slot, remember_answer, vector, context, response)
+                yield sse_event("done", response.dict())
+        
+        except RequestCancelledError:
+            # Nobody is listening anymore
+            return
+        except Exception as e:
+            print(e)
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            watcher.cancel()
+            slot.release()
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+class BatchRequest(BaseModel):
+    input_path: str
+    output_path: str
+
+# POST method to process a JSONL file of {session_id, request} records in the background.
+# Paths are relative to BATCH_DIR; submitting the same files again resumes an interrupted job.
+@app.post("/batch", dependencies=[Depends(require_models)])
+async def create_batch_job(request: BatchRequest):
+    # With a single chat slot a batch would hold it for the whole job and starve interactive requests
+    if executor.lane("chat").concurrency < 2:
+        raise HTTPException(status_code=409, detail="Batch jobs need at least 2 chat slots so one stays free for interactive requests; run python batch.py offline instead")
+    try:
+        input_path = resolve_batch_path(request.input_path)
+        output_path = resolve_batch_path(request.output_path)
+        job = batch_runner.submit(input_path, output_path)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return job.to_dict()
+
+# GET method to check the progress of a batch job
+@app.get("/batch/{job_id}")
+def get_batch_job(job_id: str):
+    job = batch_runner.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return job.to_dict()
+
+# DELETE method to stop a batch job; its checkpoint is kept for resuming
+@app.delete("/batch/{job_id}")
+async def cancel_batch_job(job_id: str):
+    job = batch_runner.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return job.to_dict()
+
+# GET method to check the status of a deferred summary
+@app.get("/summary-jobs/{job_id}")
+def get_summary_job(job_id: str):
+    job = summary_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Summary job not found")
+    return job.to_dict()
+
+# Gauges read from the stats the modules already keep, at scrape time
+def collect_stats():
+    gauges = []
+    for lane, lane_stats in executor.stats().items():
+        gauges.extend(metrics.stats_gauges("inference", lane_stats, "Inference lane state", {"lane": lane}))
+    registry = model_stats()
+    gauges.extend(metrics.stats_gauges("process", {"resident_memory_bytes": registry["resident_memory_bytes"]}, "Process state"))
+    for name, pool in registry["models"].items():
+        gauges.extend(metrics.stats_gauges("model", pool, "Model pool state", {"model": name}))
+    for name, cache in prefix_cache_stats().items():
+        gauges.extend(metrics.stats_gauges("prefix_cache", cache, "Prefix cache state", {"model": name}))
+    gauges.extend(metrics.stats_gauges("summary_cache", summary_cache.stats(), "Summary cache state"))
+    gauges.extend(metrics.stats_gauges("summary_queue", summary_queue.stats(), "Deferred summary queue state"))
+    gauges.extend(metrics.stats_gauges("context_cache", context_cache.stats(), "Context cache state"))
+    for flight in (generate_flight, summarize_flight, validation_flight):
+        gauges.extend(metrics.stats_gauges("coalescing", flight.stats(), "Request coalescing state", {"flight": flight.name}))
+    for site, site_stats in speculative_stats().items():
+        gauges.extend(metrics.stats_gauges("speculative", site_stats, "Speculative decoding state", {"site": site}))
+    gauges.extend(metrics.stats_gauges("tracing", tracing_stats(), "Trace exporter state"))
+    gauges.extend(metrics.stats_gauges("batch", batch_runner.stats(), "Batch job state"))
+    gauges.extend(metrics.stats_gauges("lifecycle", lifecycle.stats(), "Startup state and phase durations"))
+    if memory_queue is not None:
+        gauges.extend(metrics.stats_gauges("session_memory", memory_queue.stats(), "Session memory queue state"))
+    if semantic_cache is not None:
+        gauges.extend(metrics.stats_gauges("semantic_cache", semantic_cache.stats(), "Semantic cache state"))
+    if batch_scheduler is not None:
+        gauges.extend(metrics.stats_gauges("scheduler", batch_scheduler.stats(), "Batch scheduler state"))
+    return gauges
+
+metrics.add_collector(collect_stats)
+
+# GET method to scrape the metrics in the Prometheus text format
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# GET method for liveness: the process is up and serving HTTP
+@app.get("/healthz")
+def get_health():
+    return {"status": "ok", "uptime_seconds": lifecycle.stats()["uptime_seconds"]}
+
+# GET method for readiness: the database is set up and the models are loaded and warmed
+@app.get("/readyz")
+def get_readiness():
+    stats = lifecycle.stats()
+    if not lifecycle.ready:
+        return JSONResponse(status_code=503, content=stats)
+    return stats
+
+# GET method to retrieve model load times, memory usage and inference queue state
+@app.get("/models")
+def get_model_stats():
+    stats = model_stats()
+    stats["inference"] = executor.stats()
+    stats["prefix_cache"] = prefix_cache_stats()
+    stats["summary_cache"] = summary_cache.stats()
+    stats["summary_queue"] = summary_queue.stats()
+    stats["context_cache"] = context_cache.stats()
+    stats["coalescing"] = {flight.name: flight.stats() for flight in (generate_flight, summarize_flight, validation_flight)}
+    stats["speculative"] = speculative_stats()
+    stats["tracing"] = tracing_stats()
+    stats["batch"] = batch_runner.stats()
+    stats["lifecycle"] = lifecycle.stats()
+    if memory_queue is not None:
+        stats["session_memory"] = memory_queue.stats()
+    if semantic_cache is not None:
+        stats["semantic_cache"] = semantic_cache.stats()
+    if batch_scheduler is not None:
+        stats["scheduler"] = batch_scheduler.stats()
+    return stats
+
+# GET method to retrieve conversation history
+@app.get("/history/{session_id}", response_model= NumHisCon)
+@observe()
+async def get_conversation_history(session_id: str):
+    try:
+        async with SessionLocal() as db_session:
+            # Read from the session's counters instead of loading its rows
+            stats = await get_session_stats(db_session, session_id)
+            return NumHisCon(
+                num_conversations=stats.turn_count if stats is not None else 0
+            )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# GET method to retrieve the counters of a session
+@app.get("/sessions/{session_id}/stats", response_model=SessionStatsResponse)
+async def get_session_statistics(session_id: str):
+    async with SessionLocal() as db_session:
+        stats = await get_session_stats(db_session, session_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="No conversations found for the given session_id")
+    return SessionStatsResponse(
+        session_id=stats.session_id,
+        turn_count=stats.turn_count,
+        total_tokens=stats.total_tokens,
+        bytes_stored=stats.bytes_stored,
+        created_at=stats.created_at,
+        last_activity=stats.last_activity
+    )
+
+# Stream the turns of a session after `after_id` as NDJSON.
+# Each batch is read through a server-side cursor in its own short transaction,
+# so neither memory nor the transaction grows with the session.
+async def export_turns(session_id: str, after_id: int, fields: str):
+    while True:
+        rows = 0
+        async with SessionLocal() as db_session:
+            result = await db_session.stream(
+                turns_query(session_id, after_id, fields, TURNS_EXPORT_BATCH).execution_options(yield_per=TURNS_EXPORT_BATCH)
+            )
+            async for row in result:
+                turn = dict(row._mapping)
+                after_id = turn["id"]
+                rows += 1
+                yield json.dumps(turn) + "\n"
+        if rows < TURNS_EXPORT_BATCH:
+            return
+
+# GET method to read the transcript of a session, oldest turn first.
+# `after` is the id of the last turn already read (keyset pagination), `fields` picks the
+# full response, the summarized one or both, and format=ndjson exports every turn after `after`.
+@app.get("/sessions/{session_id}/turns", response_model=TurnsPage)
+async def get_session_turns(
+    session_id: str,
+    after: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=TURNS_PAGE_LIMIT),
+    fields: Literal["full", "summarized", "both"] = "full",
+    format: Literal["json", "ndjson"] = "json",
+):
+    if format == "ndjson":
+        return StreamingResponse(export_turns(session_id, after, fields), media_type="application/x-ndjson")
+    
+    # One extra row tells whether there is a next page
+    async with SessionLocal() as db_session:
+        result = await db_session.execute(turns_query(session_id, after, fields, limit + 1))
+        rows = [dict(row._mapping) for row in result]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return TurnsPage(
+        session_id=session_id,
+        turns=[Turn(**row) for row in rows],
+        next_cursor=rows[-1]["id"] if has_more else None
+    )
+
+# DELETE method to delete conversation history
+@app.delete("/delete-history/{session_id}")
+@observe()
+async def delete_context(session_id: str):
+    async with SessionLocal() as db_session:
+        try:
+            # Delete all conversations associated with the given session id, with their counters
+            deleted_rows = await delete_session(db_session, session_id)
+
+            # Commit the transaction to make the change persistent
+            await db_session.commit()
+            context_cache.invalidate(session_id)
+        
+        except Exception as e:
+            await db_session.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
+
+    if deleted_rows == 0:
+        raise HTTPException(status_code=404, detail="No conversations found for the given session_id")
+    
+    return {"message": f"Deleted {deleted_rows} conversation(s) for session_id: {session_id}"}
+
+# Load the registered models (the load hook primes the system prompt), then warm them up
+async def load_models():
+    global batch_scheduler, SYSTEM_PROMPT_TOKENS, CONTEXT_BUDGET
+    with lifecycle.timed("model_load"):
+        await asyncio.to_thread(load_all)
+    SYSTEM_PROMPT_TOKENS = len(tokenizer.encode(SYSTEM_PROMPT, False))
+    CONTEXT_BUDGET = MODEL_N_CTX - SYSTEM_PROMPT_TOKENS - RESERVED_OUTPUT_TOKENS
+    if SCHEDULER_SLOTS > 0:
+        with lifecycle.timed("scheduler"):
+            batch_scheduler = await asyncio.to_thread(get_scheduler)
+    if MODEL_WARMUP:
+        with lifecycle.timed("warmup"):
+            await asyncio.to_thread(warmup)
+
+# Decode a few tokens of a chat prompt so the first request finds warm caches
+def warmup():
+    prompt = f"{SYSTEM_PROMPT}<|start_header_id|>user<|end_header_id|>\n\n{MODEL_WARMUP_PROMPT}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
+    if batch_scheduler is not None:
+        batch_scheduler.generate(prompt, max_tokens=MODEL_WARMUP_TOKENS, temperature=0.5, top_p=0.5)
+        return
+    with acquire("chat") as model:
+        model.llama(prompt=prompt, max_tokens=MODEL_WARMUP_TOKENS, temperature=0.5, top_p=0.5)
+
+# Create the database tables, remember the event loop for worker threads and start loading the models
+async def startup():
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    with lifecycle.timed("database"):
+        await init_db()
+    summary_cache.start(event_loop)
+    lifecycle.started = True
+    if lifecycle.mode == "eager":
+        await lifecycle.load(load_models)
+    elif lifecycle.mode == "background":
+        lifecycle.load(load_models)
+
+# Finish queued summaries and stop the inference pool when the server shuts down
+async def shutdown():
+    await batch_runner.shutdown()
+    # The queues write through the event loop, so they are drained from another thread
+    await asyncio.to_thread(summary_queue.drain, SUMMARY_DRAIN_TIMEOUT)
+    if memory_queue is not None:
+        await asyncio.to_thread(memory_queue.drain, SUMMARY_DRAIN_TIMEOUT)
+    if semantic_cache is not None:
+        semantic_cache.save()
+    await asyncio.to_thread(tracer.drain, TRACE_DRAIN_TIMEOUT)
+    if batch_scheduler is not None:
+        batch_scheduler.shutdown()
+    executor.shutdown()
+
+# Exception handler for requests rejected because the inference queue is full
+@app.exception_handler(QueueFullError)
+async def queue_full_exception_handler(request: Request, exc: QueueFullError):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+# Exception handler for requests that ran out of time waiting for or running inference
+@app.exception_handler(DeadlineExceededError)
+async def deadline_exception_handler(request: Request, exc: DeadlineExceededError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+# Exception handler for requests whose client disconnected before they finished (nginx's 499)
+@app.exception_handler(RequestCancelledError)
+async def cancelled_exception_handler(request: Request, exc: RequestCancelledError):
+    return JSONResponse(status_code=499, content={"detail": str(exc)})
+
+# Exception handler for an Idempotency-Key reused by another session or with another request
+@app.exception_handler(IdempotencyKeyMismatchError)
+async def idempotency_mismatch_exception_handler(request: Request, exc: IdempotencyKeyMismatchError):
+    return JSONResponse(status_code=422, content={"detail": str(exc)})
+
+# Exception handler for invalid request format
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    return JSONResponse(
+        status_code=422,
+        content={"detail": "Invalid request format. Please check the request body."}
+    )
+    
+#
+#"""
+#        return [
+#            Response(
+#                session_id=chat.session_id,
+#                user_prompt=chat.user_prompt,
+#                response=chat.response,
+#                summarized_response=chat.summarized_response,
+#                context=[]
+#            )
+#            for chat in chatbox
+ #       ]
   #      """
\ No newline at end of file
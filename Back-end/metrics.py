@@ -0,0 +1,186 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import llama_cpp
+
+# Prometheus metrics kept in process, rendered in the text exposition format by render().
+# No client library or network access is needed: /metrics serves render().
+
+# Seconds, from a cache hit to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+# Tokens per second of a prefill or decode
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+PREFIX = "chatbox_"
+
+def _labels_text(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_labels_text(key)} {_number(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: count per bucket (non cumulative, plus +Inf), sum, count
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_labels_text(key + (('le', _number(bound)),))} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels_text(key)} {_number(total)}")
+                lines.append(f"{self.name}_count{_labels_text(key)} {count}")
+        return lines
+
+_metrics: Dict[str, object] = {}
+_collectors: List[Callable[[], Iterable[tuple]]] = []
+_registry_lock = threading.Lock()
+
+# Get or create a counter; the name is prefixed with "chatbox_"
+def counter(name: str, help: str) -> Counter:
+    with _registry_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = Counter(PREFIX + name, help)
+        return metric
+
+# Get or create a histogram; the name is prefixed with "chatbox_"
+def histogram(name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+    with _registry_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = Histogram(PREFIX + name, help, buckets)
+        return metric
+
+# Register `collect()` returning (name, help, [(labels dict, value), ...]) gauges read at scrape time,
+# so state that modules already track (queue depths, cache counters) is not counted twice
+def add_collector(collect: Callable[[], Iterable[tuple]]):
+    _collectors.append(collect)
+
+# Gauges for every numeric leaf of a stats() dict, named <name>_<key>[_<nested key>...]
+def stats_gauges(name: str, stats: dict, help: str, labels: Optional[dict] = None) -> List[tuple]:
+    gauges = []
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            gauges.extend(stats_gauges(f"{name}_{key}", value, help, labels))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            gauges.append((f"{name}_{key}", help, [(labels or {}, value)]))
+        elif isinstance(value, bool):
+            gauges.append((f"{name}_{key}", help, [(labels or {}, int(value))]))
+    return gauges
+
+stage_seconds = histogram("stage_seconds", "Time spent in each stage of the pipeline")
+stage_errors = counter("stage_errors_total", "Stages that raised")
+
+# Time a block as one pipeline stage: `with stage("validate"): ...`
+@contextmanager
+def stage(name: str, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage=name, **labels)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=name, **labels)
+
+prefill_tokens = counter("prefill_tokens_total", "Prompt tokens evaluated by llama.cpp")
+prefill_seconds = counter("prefill_seconds_total", "Time llama.cpp spent evaluating prompt tokens")
+decode_tokens = counter("decode_tokens_total", "Tokens generated by llama.cpp")
+decode_seconds = counter("decode_seconds_total", "Time llama.cpp spent generating tokens")
+prefill_rate = histogram("prefill_tokens_per_second", "Prompt evaluation speed of one llama.cpp call", THROUGHPUT_BUCKETS)
+decode_rate = histogram("decode_tokens_per_second", "Generation speed of one llama.cpp call", THROUGHPUT_BUCKETS)
+
+# Record the prefill and decode work of the llama.cpp calls made in the block, from the context's perf counters
+@contextmanager
+def llama_timings(llama, site: str):
+    before = llama_cpp.llama_perf_context(llama._ctx.ctx)
+    try:
+        yield
+    finally:
+        after = llama_cpp.llama_perf_context(llama._ctx.ctx)
+        prompt_tokens = after.n_p_eval - before.n_p_eval
+        prompt_seconds = (after.t_p_eval_ms - before.t_p_eval_ms) / 1000
+        generated_tokens = after.n_eval - before.n_eval
+        generated_seconds = (after.t_eval_ms - before.t_eval_ms) / 1000
+        if prompt_tokens > 0:
+            prefill_tokens.inc(prompt_tokens, site=site)
+            prefill_seconds.inc(prompt_seconds, site=site)
+            if prompt_seconds > 0:
+                prefill_rate.observe(prompt_tokens / prompt_seconds, site=site)
+        if generated_tokens > 0:
+            decode_tokens.inc(generated_tokens, site=site)
+            decode_seconds.inc(generated_seconds, site=site)
+            if generated_seconds > 0:
+                decode_rate.observe(generated_tokens / generated_seconds, site=site)
+
+# Prometheus text exposition of every metric and collector
+def render() -> str:
+    lines: List[str] = []
+    with _registry_lock:
+        metrics = list(_metrics.values())
+    for metric in metrics:
+        lines.extend(metric.render())
+    # Samples of one gauge must be contiguous, collectors may emit a name once per label set
+    gauges: Dict[str, tuple] = {}
+    for collect in _collectors:
+        try:
+            collected = list(collect())
+        except Exception as e:
+            # One broken collector must not hide the other metrics
+            print(f"Metrics collector failed: {e}")
+            continue
+        for name, help, samples in collected:
+            gauges.setdefault(name, (help, []))[1].extend(samples)
+    for name, (help, samples) in gauges.items():
+        full_name = PREFIX + name
+        lines.append(f"# HELP {full_name} {help}")
+        lines.append(f"# TYPE {full_name} gauge")
+        for labels, value in samples:
+            lines.append(f"{full_name}{_labels_text(tuple(sorted(labels.items())))} {_number(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,184 @@
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+from dotenv import load_dotenv
+from llama_cpp import Llama, LlamaTokenizer
+import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Default llama.cpp settings shared by every call site
+MODEL_PATH = os.getenv("MODEL_PATH")
+MODEL_N_CTX = int(os.getenv("MODEL_N_CTX", "2048"))
+MODEL_N_BATCH = int(os.getenv("MODEL_N_BATCH", "512"))
+MODEL_N_GPU_LAYERS = int(os.getenv("MODEL_N_GPU_LAYERS", "-1"))
+# CPU threads for decoding and prompt evaluation (llama.cpp sizes them from the machine's cores when unset,
+# which oversubscribes a process pinned to a subset of them)
+MODEL_N_THREADS = int(os.getenv("MODEL_N_THREADS")) if os.getenv("MODEL_N_THREADS") else None
+MODEL_N_THREADS_BATCH = int(os.getenv("MODEL_N_THREADS_BATCH")) if os.getenv("MODEL_N_THREADS_BATCH") else MODEL_N_THREADS
+# Number of llama.cpp contexts kept per GGUF. The weights are mmapped, so extra
+# contexts only cost their KV cache, not a second copy of the model.
+MODEL_POOL_SIZE = int(os.getenv("MODEL_POOL_SIZE", "1"))
+
+model_loads = metrics.counter("model_loads_total", "llama.cpp contexts loaded")
+model_load_seconds = metrics.histogram("model_load_seconds", "Time to load one llama.cpp context")
+
+# One loaded llama.cpp context and the lock that serializes access to it
+class ModelHandle:
+    def __init__(self, name: str, index: int, llama: Llama, load_time: float):
+        self.name = name
+        self.index = index
+        self.llama = llama
+        self.tokenizer = LlamaTokenizer(llama)
+        self.lock = threading.Lock()
+        self.load_time = load_time
+        self.uses = 0
+
+# Pool of handles for a single GGUF, loaded lazily and at most once per slot
+class ModelPool:
+    def __init__(self, name: str, model_path: str, size: int = 1, **params):
+        self.name = name
+        self.model_path = model_path
+        self.size = max(1, size)
+        self.params = params
+        self.handles = []
+        self.load_hooks = []
+        self._idle = queue.Queue()
+        # Loads are serialized so concurrent first requests don't each map the
+        # model and spike resident memory
+        self._load_lock = threading.Lock()
+
+    def _load(self) -> ModelHandle:
+        start = time.perf_counter()
+        llama = Llama(model_path=self.model_path, **self.params)
+        handle = ModelHandle(self.name, len(self.handles), llama, time.perf_counter() - start)
+        self.handles.append(handle)
+        print(f"Loaded model '{self.name}' #{handle.index} in {handle.load_time:.2f}s")
+        model_loads.inc(model=self.name)
+        model_load_seconds.observe(handle.load_time, model=self.name)
+        for hook in self.load_hooks:
+            hook(handle)
+        return handle
+
+    # Run `hook(handle)` on every handle already loaded and on each one loaded later
+    def add_load_hook(self, hook):
+        with self._load_lock:
+            self.load_hooks.append(hook)
+            for handle in self.handles:
+                hook(handle)
+
+    # Return the first handle, loading it if needed (used for tokenization).
+    # Once loaded it is returned without the load lock, which acquire() may hold during a load.
+    def primary(self) -> ModelHandle:
+        if self.handles:
+            return self.handles[0]
+        with self._load_lock:
+            if not self.handles:
+                self._idle.put(self._load())
+            return self.handles[0]
+
+    # Load every slot of the pool, so no request has to wait for a load
+    def load_all(self):
+        with self._load_lock:
+            while len(self.handles) < self.size:
+                self._idle.put(self._load())
+
+    # Borrow a handle for exclusive use, loading a new one while the pool is not full
+    @contextmanager
+    def acquire(self, timeout: Optional[float] = None):
+        handle = None
+        try:
+            handle = self._idle.get_nowait()
+        except queue.Empty:
+            with self._load_lock:
+                if len(self.handles) < self.size:
+                    handle = self._load()
+            if handle is None:
+                handle = self._idle.get(timeout=timeout)
+        try:
+            with handle.lock:
+                handle.uses += 1
+                yield handle
+        finally:
+            self._idle.put(handle)
+
+    def stats(self) -> dict:
+        return {
+            "model_path": self.model_path,
+            "model_file_bytes": os.path.getsize(self.model_path) if self.model_path and os.path.exists(self.model_path) else None,
+            "pool_size": self.size,
+            "loaded": len(self.handles),
+            "idle": self._idle.qsize(),
+            "load_times": [round(handle.load_time, 3) for handle in self.handles],
+            "uses": [handle.uses for handle in self.handles],
+        }
+
+_pools: Dict[str, ModelPool] = {}
+_pools_lock = threading.Lock()
+
+# Register a GGUF under a name. Registering the same name again is a no-op.
+def register(name: str, model_path: str, pool_size: int = 1, **params) -> ModelPool:
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ModelPool(name, model_path, pool_size, **params)
+        return _pools[name]
+
+def get_pool(name: str = "chat") -> ModelPool:
+    try:
+        return _pools[name]
+    except KeyError:
+        raise KeyError(f"Model '{name}' is not registered")
+
+# Borrow a shared model handle: `with acquire("chat") as model: model.llama(...)`
+def acquire(name: str = "chat", timeout: Optional[float] = None):
+    return get_pool(name).acquire(timeout)
+
+# Shared handle used for read-only work such as tokenization
+def get_model(name: str = "chat") -> ModelHandle:
+    return get_pool(name).primary()
+
+# Load every handle of every registered model
+def load_all():
+    for pool in list(_pools.values()):
+        pool.load_all()
+
+# Tokenizer of a model that only loads the model when it is first used
+class PoolTokenizer:
+    def __init__(self, name: str = "chat"):
+        self.name = name
+
+    def encode(self, *args, **kwargs):
+        return get_model(self.name).tokenizer.encode(*args, **kwargs)
+
+    def decode(self, *args, **kwargs):
+        return get_model(self.name).tokenizer.decode(*args, **kwargs)
+
+# Current resident memory of the process in bytes
+def _resident_memory() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def stats() -> dict:
+    return {
+        "resident_memory_bytes": _resident_memory(),
+        "models": {name: pool.stats() for name, pool in _pools.items()},
+    }
+
+# The chat model is used by main.py, Idea_generator.py, summarize.py and validation.py
+register(
+    "chat",
+    MODEL_PATH,
+    pool_size=MODEL_POOL_SIZE,
+    n_ctx=MODEL_N_CTX,
+    n_batch=MODEL_N_BATCH,
+    n_gpu_layers=MODEL_N_GPU_LAYERS,
+    n_threads=MODEL_N_THREADS,
+    n_threads_batch=MODEL_N_THREADS_BATCH,
+)
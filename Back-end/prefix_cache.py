@@ -0,0 +1,171 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+from dotenv import load_dotenv
+from llama_cpp import Llama, LlamaState
+from llama_cpp.llama_cache import BaseLlamaCache
+from model_registry import get_pool, ModelHandle
+
+# Load environment variables from .env file
+load_dotenv()
+
+# RAM budget for saved llama.cpp states, in bytes (0 disables the cache)
+PREFIX_CACHE_BYTES = int(os.getenv("PREFIX_CACHE_BYTES", str(1 << 30)))
+# Shortest shared prefix worth restoring a state for: at least this many tokens and this fraction of the prompt.
+# A shorter match is a miss, restoring the state would cost more than prefilling those tokens again.
+PREFIX_CACHE_MIN_TOKENS = int(os.getenv("PREFIX_CACHE_MIN_TOKENS", "32"))
+PREFIX_CACHE_MIN_FRACTION = float(os.getenv("PREFIX_CACHE_MIN_FRACTION", "0.05"))
+
+# Hash of a token sequence, used as the snapshot key
+def prefix_key(tokens: Sequence[int]) -> str:
+    return hashlib.blake2b(np.asarray(tokens, dtype=np.int32).tobytes(), digest_size=16).hexdigest()
+
+# Number of leading tokens two sequences have in common
+def common_prefix(a: np.ndarray, b: np.ndarray) -> int:
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    diff = np.flatnonzero(a[:n] != b[:n])
+    return int(diff[0]) if len(diff) else n
+
+# Prompt-prefix cache of llama.cpp states, plugged into Llama.set_cache().
+# Llama looks it up before every completion and restores the state sharing the
+# longest token prefix with the prompt, so only the new suffix is prefilled; it
+# saves the state (prompt + completion) afterwards, which is the next turn's
+# prefix for that session. Only prompts under a registered root (e.g. the chat
+# SYSTEM_PROMPT) are stored, and root snapshots are never evicted.
+class PrefixCache(BaseLlamaCache):
+    def __init__(self, capacity_bytes: int = PREFIX_CACHE_BYTES, min_tokens: int = PREFIX_CACHE_MIN_TOKENS,
+                 min_fraction: float = PREFIX_CACHE_MIN_FRACTION):
+        super().__init__(capacity_bytes)
+        self.min_tokens = min_tokens
+        self.min_fraction = min_fraction
+        self._states: "OrderedDict[str, Tuple[np.ndarray, LlamaState]]" = OrderedDict()
+        self._roots: List[np.ndarray] = []
+        self._pinned = set()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.short_matches = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+    # Llama checks `if self.cache:`, an empty cache must still count as enabled
+    def __bool__(self) -> bool:
+        return True
+
+    @property
+    def cache_size(self) -> int:
+        return self._size
+
+    def add_root(self, tokens: Sequence[int]):
+        with self._lock:
+            self._roots.append(np.asarray(tokens, dtype=np.int32))
+
+    def _under_root(self, tokens: np.ndarray) -> bool:
+        return any(common_prefix(root, tokens) == len(root) for root in self._roots)
+
+    def _find(self, tokens: np.ndarray) -> Tuple[Optional[str], int]:
+        best_key, best_len = None, 0
+        for key, (stored, _) in self._states.items():
+            length = common_prefix(stored, tokens)
+            if length > best_len:
+                best_key, best_len = key, length
+        return best_key, best_len
+
+    # Best match of the prompt if it is long enough to be worth restoring
+    def _match(self, tokens: np.ndarray) -> Tuple[Optional[str], int]:
+        best_key, best_len = self._find(tokens)
+        if best_key is not None and (best_len < self.min_tokens or best_len < self.min_fraction * len(tokens)):
+            return None, best_len
+        return best_key, best_len
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        tokens = np.asarray(key, dtype=np.int32)
+        with self._lock:
+            best_key, best_len = self._match(tokens)
+            if best_key is None:
+                self.misses += 1
+                if best_len > 0:
+                    self.short_matches += 1
+                raise KeyError("No cached prefix")
+            self.hits += 1
+            self.reused_tokens += best_len
+            self._states.move_to_end(best_key)
+            return self._states[best_key][1]
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        with self._lock:
+            return self._match(np.asarray(key, dtype=np.int32))[0] is not None
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState):
+        self.store(key, value)
+
+    def store(self, key: Sequence[int], value: LlamaState, pin: bool = False):
+        tokens = np.asarray(key, dtype=np.int32)
+        with self._lock:
+            if not pin and not self._under_root(tokens):
+                return
+            hashed = prefix_key(tokens)
+            if hashed in self._states:
+                self._size -= self._states.pop(hashed)[1].llama_state_size
+            self._states[hashed] = (tokens, value)
+            self._size += value.llama_state_size
+            if pin:
+                self._pinned.add(hashed)
+            # Evict least recently used snapshots until we are back under budget
+            for old in list(self._states):
+                if self._size <= self.capacity_bytes:
+                    break
+                if old in self._pinned or old == hashed:
+                    continue
+                self._size -= self._states.pop(old)[1].llama_state_size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._states),
+            "bytes": self._size,
+            "capacity_bytes": self.capacity_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "short_matches": self.short_matches,
+            "evictions": self.evictions,
+            "reused_tokens": self.reused_tokens,
+        }
+
+# Evaluate a prompt prefix once and pin its state in the cache
+def prime(llama: Llama, cache: PrefixCache, prompt: str):
+    tokens = llama.tokenize(prompt.encode("utf-8"), special=True)
+    cache.add_root(tokens)
+    llama.reset()
+    llama.eval(tokens)
+    cache.store(tokens, llama.save_state(), pin=True)
+
+_caches = {}
+
+# Share one prefix cache across every context of a registered model and prime
+# it with the given prompt prefixes (snapshots are portable between contexts of
+# the same model)
+def enable_prefix_cache(model_name: str, prefixes: List[str]) -> Optional[PrefixCache]:
+    if PREFIX_CACHE_BYTES <= 0:
+        return None
+    cache = PrefixCache(PREFIX_CACHE_BYTES)
+    _caches[model_name] = cache
+
+    def attach(handle: ModelHandle):
+        with handle.lock:
+            handle.llama.set_cache(cache)
+            if handle.index == 0:
+                for prefix in prefixes:
+                    prime(handle.llama, cache, prefix)
+
+    get_pool(model_name).add_load_hook(attach)
+    return cache
+
+def stats() -> dict:
+    return {name: cache.stats() for name, cache in _caches.items()}
@@ -0,0 +1,307 @@
+import codecs
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterator, List, Optional
+import numpy as np
+import llama_cpp
+from llama_cpp._internals import LlamaBatch, LlamaContext
+from dotenv import load_dotenv
+from model_registry import get_model
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Number of sequences decoded together in one llama.cpp context (0 disables the scheduler)
+SCHEDULER_SLOTS = int(os.getenv("SCHEDULER_SLOTS", "0"))
+# KV cache reserved for each slot, in tokens
+SCHEDULER_SLOT_N_CTX = int(os.getenv("SCHEDULER_SLOT_N_CTX", "2048"))
+# Tokens decoded per llama_decode step, shared by every active sequence
+SCHEDULER_N_BATCH = int(os.getenv("SCHEDULER_N_BATCH", "512"))
+# Largest prompt chunk one sequence may prefill per step, so a long prompt
+# cannot starve the sequences that are already generating
+SCHEDULER_PREFILL_CHUNK = int(os.getenv("SCHEDULER_PREFILL_CHUNK", "128"))
+
+# One generation request tracked by the scheduler
+class Sequence:
+    def __init__(self, prompt_tokens: List[int], max_tokens: int, temperature: float, top_p: float, top_k: int,
+                 should_stop: Optional[Callable[[], bool]] = None):
+        self.prompt_tokens = prompt_tokens
+        # Polled every step; a sequence whose request was cancelled leaves the batch
+        self.should_stop = should_stop
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.slot: Optional[int] = None
+        self.n_prefilled = 0
+        self.output_tokens: List[int] = []
+        self.finish_reason: Optional[str] = None
+        self.pieces = queue.Queue()
+        self.done = threading.Event()
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._text: List[str] = []
+
+    @property
+    def n_past(self) -> int:
+        return self.n_prefilled + len(self.output_tokens)
+
+    def prefilling(self) -> bool:
+        return self.n_prefilled < len(self.prompt_tokens)
+
+    def push(self, piece: bytes):
+        text = self._decoder.decode(piece)
+        if text:
+            self._text.append(text)
+            self.pieces.put(text)
+
+    def finish(self, reason: str):
+        self.finish_reason = reason
+        text = self._decoder.decode(b"", final=True)
+        if text:
+            self._text.append(text)
+            self.pieces.put(text)
+        self.pieces.put(None)
+        self.done.set()
+
+    def text(self) -> str:
+        return "".join(self._text)
+
+# Continuous-batching decoder: interleaves many sessions in one llama.cpp context.
+# Each active sequence owns a KV slot (seq_id); every step decodes one token for
+# each generating sequence plus prompt chunks for newly admitted ones, so requests
+# join and leave at token granularity.
+class BatchScheduler:
+    def __init__(self, model_name: str = "chat", slots: int = SCHEDULER_SLOTS, slot_n_ctx: int = SCHEDULER_SLOT_N_CTX,
+                 n_batch: int = SCHEDULER_N_BATCH, prefill_chunk: int = SCHEDULER_PREFILL_CHUNK):
+        self.slots = max(1, slots)
+        self.slot_n_ctx = slot_n_ctx
+        self.n_batch = n_batch
+        self.prefill_chunk = max(1, prefill_chunk)
+
+        # Reuse the weights already loaded by the registry, only the context is new
+        llama = get_model(model_name).llama
+        self._model = llama._model
+        self._vocab = self._model.vocab
+        self._n_vocab = self._model.n_vocab()
+        params = LlamaContext.default_params()
+        params.n_ctx = self.slots * slot_n_ctx
+        params.n_batch = n_batch
+        params.n_ubatch = n_batch
+        params.n_seq_max = self.slots
+        params.n_threads = llama.n_threads
+        params.n_threads_batch = llama.n_threads_batch
+        if hasattr(params, "kv_unified"):
+            params.kv_unified = True
+        self._ctx = LlamaContext(model=self._model, params=params, verbose=False)
+        self._batch = LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=1, verbose=False)
+        self._rng = np.random.default_rng()
+
+        self._pending = deque()
+        self._active: Dict[int, Sequence] = {}
+        self._free_slots = list(range(self.slots))
+        self._cursor = 0
+        self._cond = threading.Condition()
+        self._running = True
+
+        # Throughput counters
+        self.steps = 0
+        self.generated_tokens = 0
+        self.prefilled_tokens = 0
+        self.decode_time = 0.0
+        self.cancelled = 0
+
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    # Queue a prompt for generation and return its sequence
+    def submit(self, prompt: str, max_tokens: int = -1, temperature: float = 0.5, top_p: float = 0.5, top_k: int = 40,
+               should_stop: Optional[Callable[[], bool]] = None) -> Sequence:
+        tokens = self._model.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+        if len(tokens) >= self.slot_n_ctx:
+            raise ValueError(f"Prompt has {len(tokens)} tokens, the slot context is {self.slot_n_ctx}")
+        sequence = Sequence(tokens, max_tokens, temperature, top_p, top_k, should_stop)
+        with self._cond:
+            self._pending.append(sequence)
+            self._cond.notify()
+        return sequence
+
+    # Blocking helper with the same result shape as Llama.__call__
+    def generate(self, prompt: str, **kwargs) -> dict:
+        sequence = self.submit(prompt, **kwargs)
+        sequence.done.wait()
+        return {
+            "choices": [{"text": sequence.text(), "finish_reason": sequence.finish_reason}],
+            "usage": {
+                "prompt_tokens": len(sequence.prompt_tokens),
+                "completion_tokens": len(sequence.output_tokens),
+                "total_tokens": len(sequence.prompt_tokens) + len(sequence.output_tokens),
+            },
+        }
+
+    # Yield text pieces as they are decoded
+    def stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        sequence = self.submit(prompt, **kwargs)
+        while True:
+            piece = sequence.pieces.get()
+            if piece is None:
+                return
+            yield piece
+
+    # Finish cancelled sequences, freeing their slots before the next step
+    def _drop_cancelled(self):
+        for sequence in [sequence for sequence in self._pending if sequence.should_stop is not None and sequence.should_stop()]:
+            self._pending.remove(sequence)
+            sequence.finish("cancelled")
+            self.cancelled += 1
+        for sequence in list(self._active.values()):
+            if sequence.should_stop is not None and sequence.should_stop():
+                self._release(sequence, "cancelled")
+                self.cancelled += 1
+
+    def _admit(self):
+        while self._pending and self._free_slots:
+            sequence = self._pending.popleft()
+            sequence.slot = self._free_slots.pop(0)
+            self._active[sequence.slot] = sequence
+
+    def _release(self, sequence: Sequence, reason: str):
+        self._ctx.kv_cache_seq_rm(sequence.slot, -1, -1)
+        del self._active[sequence.slot]
+        self._free_slots.append(sequence.slot)
+        sequence.finish(reason)
+
+    def _add(self, token: int, pos: int, seq_id: int, logits: bool):
+        batch = self._batch.batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.seq_id[i][0] = seq_id
+        batch.n_seq_id[i] = 1
+        batch.logits[i] = logits
+        batch.n_tokens = i + 1
+        return i
+
+    # Fill one batch: generating sequences first (one token each), then prompt
+    # chunks, visiting sequences round-robin so no session is starved
+    def _fill_batch(self) -> Dict[int, Sequence]:
+        self._batch.reset()
+        budget = self.n_batch
+        order = sorted(self._active)
+        if order:
+            shift = self._cursor % len(order)
+            order = order[shift:] + order[:shift]
+            self._cursor += 1
+        sampled: Dict[int, Sequence] = {}
+
+        for slot in order:
+            sequence = self._active[slot]
+            if budget == 0 or sequence.prefilling():
+                continue
+            i = self._add(sequence.output_tokens[-1], sequence.n_past - 1, slot, True)
+            sampled[i] = sequence
+            budget -= 1
+
+        for slot in order:
+            sequence = self._active[slot]
+            if budget == 0 or not sequence.prefilling():
+                continue
+            start = sequence.n_prefilled
+            chunk = sequence.prompt_tokens[start:start + min(self.prefill_chunk, budget)]
+            for offset, token in enumerate(chunk):
+                last = start + offset == len(sequence.prompt_tokens) - 1
+                i = self._add(token, start + offset, slot, last)
+                if last:
+                    sampled[i] = sequence
+            sequence.n_prefilled += len(chunk)
+            self.prefilled_tokens += len(chunk)
+            budget -= len(chunk)
+        return sampled
+
+    def _sample(self, i: int, sequence: Sequence) -> int:
+        logits = np.ctypeslib.as_array(self._ctx.get_logits_ith(i), shape=(self._n_vocab,))
+        if sequence.temperature <= 0:
+            return int(np.argmax(logits))
+        top_k = min(sequence.top_k, self._n_vocab) if sequence.top_k > 0 else self._n_vocab
+        candidates = np.argpartition(logits, -top_k)[-top_k:]
+        scores = logits[candidates].astype(np.float64) / sequence.temperature
+        order = np.argsort(scores)[::-1]
+        candidates, scores = candidates[order], scores[order]
+        probs = np.exp(scores - scores[0])
+        probs /= probs.sum()
+        keep = int(np.searchsorted(np.cumsum(probs), sequence.top_p)) + 1
+        probs = probs[:keep] / probs[:keep].sum()
+        return int(self._rng.choice(candidates[:keep], p=probs))
+
+    def _step(self):
+        sampled = self._fill_batch()
+        if self._batch.n_tokens() == 0:
+            return
+        start = time.perf_counter()
+        self._ctx.decode(self._batch)
+        self.decode_time += time.perf_counter() - start
+        self.steps += 1
+
+        for i, sequence in sampled.items():
+            token = self._sample(i, sequence)
+            if llama_cpp.llama_vocab_is_eog(self._vocab, token):
+                self._release(sequence, "stop")
+                continue
+            sequence.output_tokens.append(token)
+            sequence.push(self._model.token_to_piece(token))
+            self.generated_tokens += 1
+            if sequence.max_tokens > 0 and len(sequence.output_tokens) >= sequence.max_tokens:
+                self._release(sequence, "length")
+            elif sequence.n_past >= self.slot_n_ctx:
+                self._release(sequence, "length")
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                self._drop_cancelled()
+                self._admit()
+                while self._running and not self._active:
+                    self._cond.wait()
+                    self._admit()
+                if not self._running:
+                    return
+            try:
+                self._step()
+            except Exception as e:
+                # A failed decode aborts every sequence in the batch
+                print(e)
+                for sequence in list(self._active.values()):
+                    self._release(sequence, "error")
+
+    def stats(self) -> dict:
+        return {
+            "slots": self.slots,
+            "active": len(self._active),
+            "pending": len(self._pending),
+            "steps": self.steps,
+            "prefilled_tokens": self.prefilled_tokens,
+            "generated_tokens": self.generated_tokens,
+            "cancelled": self.cancelled,
+            "tokens_per_second": round((self.generated_tokens + self.prefilled_tokens) / self.decode_time, 2) if self.decode_time else None,
+        }
+
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout=5)
+
+_scheduler: Optional[BatchScheduler] = None
+_scheduler_lock = threading.Lock()
+
+# Shared scheduler for the chat model, or None when SCHEDULER_SLOTS is 0
+def get_scheduler() -> Optional[BatchScheduler]:
+    global _scheduler
+    if SCHEDULER_SLOTS <= 0:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = BatchScheduler()
+        return _scheduler
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+import numpy as np
+import llama_cpp
+from dotenv import load_dotenv
+from model_registry import acquire, register, MODEL_PATH, MODEL_N_GPU_LAYERS, MODEL_N_THREADS, MODEL_N_THREADS_BATCH
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Opt-in: serve validated answers of near-duplicate requests from the cache
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1"
+# Cosine similarity needed to reuse a cached answer
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+# Most answers kept; the least recently used one is evicted beyond that
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+# Index files: <path>.npz holds the vectors, <path>.json the answers
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "./semantic_cache")
+# Inserts between two saves of the index
+SEMANTIC_CACHE_SAVE_EVERY = int(os.getenv("SEMANTIC_CACHE_SAVE_EVERY", "20"))
+# GGUF used for embeddings (the chat model by default, in a separate embedding context)
+EMBEDDING_MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH", MODEL_PATH)
+
+# Identifies the conversation state an answer was generated in.
+# A cached answer is only reused for a request with the same context.
+def context_key(context: List[str]) -> str:
+    return hashlib.sha256("".join(context).encode("utf-8")).hexdigest()
+
+# NumPy-backed similarity index of validated answers, persisted to disk
+class SemanticCache:
+    def __init__(self, path: str = SEMANTIC_CACHE_PATH, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._vectors: Optional[np.ndarray] = None
+        self._entries: List[dict] = []
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.lookups = 0
+        self.hits = 0
+        self.inserts = 0
+        self.evictions = 0
+        self.hit_similarity_total = 0.0
+        self.lookup_time_total = 0.0
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(f"{self.path}.npz") and os.path.exists(f"{self.path}.json")):
+            return
+        try:
+            self._vectors = np.load(f"{self.path}.npz")["vectors"]
+            with open(f"{self.path}.json") as entries_file:
+                self._entries = json.load(entries_file)
+        except Exception as e:
+            # A corrupt index is dropped, it only costs cache misses
+            print(f"Could not load semantic cache: {e}")
+            self._vectors, self._entries = None, []
+
+    def save(self):
+        with self._lock:
+            if self._vectors is None:
+                return
+            np.savez(f"{self.path}.npz", vectors=self._vectors)
+            with open(f"{self.path}.json", "w") as entries_file:
+                json.dump(self._entries, entries_file)
+            self._unsaved = 0
+
+    # Mean-pooled, normalized embedding of the text
+    def embed(self, text_input: str) -> np.ndarray:
+        with acquire("embedding") as model:
+            vector = model.llama.embed(text_input, normalize=True)
+        return np.asarray(vector, dtype=np.float32)
+
+    # Best cached entry for the vector within the same context, if similar enough
+    def lookup(self, vector: np.ndarray, context: str) -> Optional[dict]:
+        start = time.perf_counter()
+        with self._lock:
+            self.lookups += 1
+            entry = None
+            if self._vectors is not None and len(self._entries):
+                similarities = self._vectors @ vector
+                for index in np.argsort(similarities)[::-1]:
+                    if similarities[index] < self.threshold:
+                        break
+                    if self._entries[index]["context"] == context:
+                        entry = self._entries[index]
+                        entry["hits"] += 1
+                        entry["last_used"] = time.time()
+                        self.hits += 1
+                        self.hit_similarity_total += float(similarities[index])
+                        break
+            self.lookup_time_total += time.perf_counter() - start
+            return entry
+
+    def add(self, vector: np.ndarray, context: str, request: str, response: str, summarized_response: Optional[str]):
+        with self._lock:
+            entry = {
+                "context": context,
+                "request": request,
+                "response": response,
+                "summarized_response": summarized_response,
+                "hits": 0,
+                "created_at": time.time(),
+                "last_used": time.time(),
+            }
+            if self._vectors is None:
+                self._vectors = vector[np.newaxis, :]
+            else:
+                self._vectors = np.vstack([self._vectors, vector])
+            self._entries.append(entry)
+            self.inserts += 1
+            # Evict the least recently used answers
+            if len(self._entries) > self.max_entries:
+                keep = np.argsort([item["last_used"] for item in self._entries])[len(self._entries) - self.max_entries:]
+                keep.sort()
+                self.evictions += len(self._entries) - len(keep)
+                self._vectors = self._vectors[keep]
+                self._entries = [self._entries[index] for index in keep]
+            self._unsaved += 1
+            should_save = self._unsaved >= SEMANTIC_CACHE_SAVE_EVERY
+        if should_save:
+            self.save()
+
+    # Fill in the summary of cached answers that were added before their deferred summary was ready
+    def add_summary(self, response: str, summarized_response: str):
+        with self._lock:
+            for entry in self._entries:
+                if entry["response"] == response and entry["summarized_response"] is None:
+                    entry["summarized_response"] = summarized_response
+                    self._unsaved += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else None,
+            "inserts": self.inserts,
+            "evictions": self.evictions,
+            "avg_hit_similarity": round(self.hit_similarity_total / self.hits, 4) if self.hits else None,
+            "avg_lookup_ms": round(1000 * self.lookup_time_total / self.lookups, 3) if self.lookups else None,
+        }
+
+# Shared cache, or None unless SEMANTIC_CACHE=1
+semantic_cache: Optional[SemanticCache] = None
+if SEMANTIC_CACHE:
+    register(
+        "embedding",
+        EMBEDDING_MODEL_PATH,
+        embedding=True,
+        pooling_type=llama_cpp.LLAMA_POOLING_TYPE_MEAN,
+        n_ctx=512,
+        n_gpu_layers=MODEL_N_GPU_LAYERS,
+        n_threads=MODEL_N_THREADS,
+        n_threads_batch=MODEL_N_THREADS_BATCH,
+        verbose=False,
+    )
+    semantic_cache = SemanticCache()
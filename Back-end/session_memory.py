@@ -0,0 +1,87 @@
+import os
+import queue
+import threading
+import time
+from typing import Callable
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Replace the turns that fell out of the window with a rolling summary (opt-in with SESSION_MEMORY=1).
+# Each fold is a model call made off the request path, outside the inference admission control.
+SESSION_MEMORY = os.getenv("SESSION_MEMORY", "0") == "1"
+# Newest turns kept verbatim next to the memory
+SESSION_MEMORY_TURNS = int(os.getenv("SESSION_MEMORY_TURNS", "2"))
+# Most turns folded in one pass; older unfolded turns (e.g. of sessions from before the memory existed) are skipped
+SESSION_MEMORY_MAX_FOLD = int(os.getenv("SESSION_MEMORY_MAX_FOLD", "8"))
+
+# Render the memory as it appears in the prompt, right after the system prompt
+def render_memory(summary: str) -> str:
+    return f"<|start_header_id|>system<|end_header_id|>\n\nSummary of the earlier conversation: {summary}<|eot_id|>"
+
+# Folds sessions' old turns into their memory off the request path.
+# `fold_session(session_id)` does the work and returns the number of turns it folded.
+# A session is queued at most once, and one worker keeps the folds of a session in order.
+class MemoryQueue:
+    def __init__(self, fold_session: Callable[[str], int]):
+        self.fold_session = fold_session
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.folds = 0
+        self.turns_folded = 0
+        self.failed = 0
+        self.fold_time_total = 0.0
+        self._thread = threading.Thread(target=self._worker, name="memory-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, session_id: str):
+        if self._stopping:
+            return
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        self._queue.put(session_id)
+
+    def _worker(self):
+        while True:
+            session_id = self._queue.get()
+            if session_id is None:
+                self._queue.task_done()
+                return
+            with self._lock:
+                self._pending.discard(session_id)
+            start = time.perf_counter()
+            try:
+                folded = self.fold_session(session_id)
+                if folded:
+                    self.folds += 1
+                    self.turns_folded += folded
+                    self.fold_time_total += time.perf_counter() - start
+            except Exception as e:
+                # The turns stay unfolded and are picked up by the session's next fold
+                self.failed += 1
+                print(f"Memory fold of session {session_id} failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    # Finish the queued folds (up to `timeout` seconds) and stop the worker
+    def drain(self, timeout: float = 60):
+        self._stopping = True
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self._queue.put(None)
+        self._thread.join(timeout=max(0.0, deadline - time.monotonic()))
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "folds": self.folds,
+            "turns_folded": self.turns_folded,
+            "failed": self.failed,
+            "avg_fold_ms": round(1000 * self.fold_time_total / self.folds, 1) if self.folds else None,
+        }
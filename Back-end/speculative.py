@@ -0,0 +1,149 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional
+import numpy as np
+import llama_cpp
+from dotenv import load_dotenv
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+from model_registry import acquire, get_pool, register, MODEL_N_CTX, MODEL_N_BATCH, MODEL_N_GPU_LAYERS, MODEL_N_THREADS, MODEL_N_THREADS_BATCH, MODEL_POOL_SIZE
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Speculative decoding per call site: "off", "lookup" (n-grams of the prompt) or "draft" (a small GGUF).
+# The target model verifies every drafted token, so outputs are the same as without speculation.
+SPECULATIVE_MODES = {
+    "chat": os.getenv("SPECULATIVE_CHAT", "off"),
+    "summarize": os.getenv("SPECULATIVE_SUMMARIZE", "off"),
+    "validate": os.getenv("SPECULATIVE_VALIDATE", "off"),
+}
+# Prompt lookup: longest n-gram matched and tokens proposed per step
+SPECULATIVE_NGRAM_SIZE = int(os.getenv("SPECULATIVE_NGRAM_SIZE", "2"))
+SPECULATIVE_LOOKUP_TOKENS = int(os.getenv("SPECULATIVE_LOOKUP_TOKENS", "10"))
+# Draft model: a GGUF with the same vocabulary as the chat model (e.g. Llama 3.2 1B for Llama 3.1 8B)
+DRAFT_MODEL_PATH = os.getenv("DRAFT_MODEL_PATH")
+SPECULATIVE_DRAFT_TOKENS = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", "4"))
+
+# Greedy drafts from a small GGUF, borrowed from the "draft" pool for each step.
+# The draft context keeps its KV cache, so only the tokens added since its last step are evaluated.
+class GGUFDraftModel(LlamaDraftModel):
+    def __init__(self, model_name: str = "draft", num_pred_tokens: int = SPECULATIVE_DRAFT_TOKENS):
+        self.model_name = model_name
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs) -> np.ndarray:
+        with acquire(self.model_name) as model:
+            llama = model.llama
+            # Evaluate at least the last token to get the logits of the next one
+            cached = llama.input_ids[:llama.n_tokens]
+            limit = min(len(cached), len(input_ids) - 1)
+            mismatch = np.nonzero(cached[:limit] != input_ids[:limit])[0]
+            llama.n_tokens = int(mismatch[0]) if len(mismatch) else limit
+            llama.eval(input_ids[llama.n_tokens:])
+
+            drafts = []
+            n_vocab = llama.n_vocab()
+            for _ in range(min(self.num_pred_tokens, llama.n_ctx() - llama.n_tokens - 1)):
+                logits = np.ctypeslib.as_array(llama._ctx.get_logits_ith(-1), shape=(n_vocab,))
+                token = int(np.argmax(logits))
+                if llama_cpp.llama_vocab_is_eog(llama._model.vocab, token):
+                    break
+                drafts.append(token)
+                llama.eval([token])
+            return np.array(drafts, dtype=np.intc)
+
+# Wraps a draft model and measures how many of its tokens the target model accepts.
+# A step's drafts are resolved at the next step of the same generation: the accepted ones
+# are the prefix of the drafts that the target then has in its input.
+class MeasuredDraft(LlamaDraftModel):
+    def __init__(self, draft: LlamaDraftModel):
+        self.draft = draft
+        self._lock = threading.Lock()
+        self._pending: Dict[int, tuple] = {}
+        self.steps = 0
+        self.drafted = 0
+        self.accepted = 0
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs) -> np.ndarray:
+        # Generations on different threads use different target contexts
+        thread = threading.get_ident()
+        with self._lock:
+            pending = self._pending.pop(thread, None)
+        if pending is not None:
+            previous_length, drafts, last_token = pending
+            # Skip drafts of a generation that ended before they could be checked
+            if len(input_ids) > previous_length and int(input_ids[previous_length - 1]) == last_token:
+                landed = input_ids[previous_length:previous_length + len(drafts)]
+                matches = np.cumprod(landed == drafts[:len(landed)])
+                with self._lock:
+                    self.drafted += len(drafts)
+                    self.accepted += int(matches.sum())
+
+        drafts = np.asarray(self.draft(input_ids, **kwargs), dtype=np.intc)
+        with self._lock:
+            self.steps += 1
+            if len(drafts):
+                self._pending[thread] = (len(input_ids), drafts, int(input_ids[-1]))
+        return drafts
+
+    def stats(self) -> dict:
+        return {
+            "steps": self.steps,
+            "drafted_tokens": self.drafted,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": round(self.accepted / self.drafted, 3) if self.drafted else None,
+        }
+
+# One measured draft per call site that enables speculation
+_drafts: Dict[str, MeasuredDraft] = {}
+for site, mode in SPECULATIVE_MODES.items():
+    if mode == "lookup":
+        _drafts[site] = MeasuredDraft(LlamaPromptLookupDecoding(SPECULATIVE_NGRAM_SIZE, SPECULATIVE_LOOKUP_TOKENS))
+    elif mode == "draft":
+        if not DRAFT_MODEL_PATH:
+            raise ValueError(f"SPECULATIVE_{site.upper()}=draft needs DRAFT_MODEL_PATH")
+        register(
+            "draft",
+            DRAFT_MODEL_PATH,
+            pool_size=MODEL_POOL_SIZE,
+            n_ctx=MODEL_N_CTX,
+            n_batch=MODEL_N_BATCH,
+            n_gpu_layers=MODEL_N_GPU_LAYERS,
+            n_threads=MODEL_N_THREADS,
+            n_threads_batch=MODEL_N_THREADS_BATCH,
+            verbose=False,
+        )
+        _drafts[site] = MeasuredDraft(GGUFDraftModel())
+    elif mode != "off":
+        raise ValueError(f"Unknown speculative decoding mode for {site}: {mode}")
+
+# Verifying drafted tokens needs the logits of every evaluated position, which llama.cpp
+# only keeps for contexts created with logits_all (the same switch Llama(draft_model=...) flips)
+if _drafts:
+    chat_pool = get_pool("chat")
+    if chat_pool.handles:
+        print("Speculative decoding: the chat model is already loaded without logits_all, speculation is disabled")
+        _drafts.clear()
+    else:
+        chat_pool.params["logits_all"] = True
+
+# Decode with the call site's draft model while the handle is borrowed:
+# `with acquire("chat") as model, speculative(model, "summarize"): model.llama(...)`
+@contextmanager
+def speculative(model, site: str):
+    draft: Optional[MeasuredDraft] = _drafts.get(site)
+    if draft is None or model.name != "chat":
+        yield model
+        return
+    model.llama.draft_model = draft
+    try:
+        yield model
+    finally:
+        model.llama.draft_model = None
+
+def stats() -> dict:
+    return {
+        site: {"mode": SPECULATIVE_MODES[site], **draft.stats()}
+        for site, draft in _drafts.items()
+    }
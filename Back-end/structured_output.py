@@ -0,0 +1,104 @@
+import json
+import os
+from typing import Optional
+from dotenv import load_dotenv
+from tracing import observe
+from llama_cpp import LlamaGrammar
+from model_registry import acquire
+from speculative import speculative
+from inference import stopping_criteria
+from metrics import llama_timings
+from validation import Verdict
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Opt-in: generate the answer and its summary in one constrained decode instead of answer + summarize()
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "0") == "1"
+# Also have the same decode label the answer, replacing the separate validation pass
+STRUCTURED_LABEL = os.getenv("STRUCTURED_LABEL", "0") == "1"
+# Most tokens of the whole JSON object (0: the rest of the context window); llama.cpp also stops at the end of the context
+STRUCTURED_MAX_TOKENS = int(os.getenv("STRUCTURED_MAX_TOKENS", "1024"))
+
+# JSON object with fixed keys in a fixed order: the summary is written after the answer it summarizes
+_STRING = r'''string ::= "\"" ( [^"\\\x7F\x00-\x1F] | "\\" ( ["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] ) )* "\""
+ws ::= [ \t\n]*'''
+ANSWER_GRAMMAR = LlamaGrammar.from_string(
+    r'''root ::= "{" ws "\"answer\":" ws string "," ws "\"summary\":" ws string ws "}"
+''' + _STRING,
+    verbose=False,
+)
+LABELED_ANSWER_GRAMMAR = LlamaGrammar.from_string(
+    r'''root ::= "{" ws "\"answer\":" ws string "," ws "\"summary\":" ws string "," ws "\"label\":" ws label ws "}"
+label ::= "\"Validated\"" | "\"Not Validated\""
+''' + _STRING,
+    verbose=False,
+)
+
+FORMAT_ROLE = """Reply with a JSON object only. \
+"answer" holds your full answer. \
+"summary" holds a short paragraph under 100 words summarizing the answer, or "" if the answer is under 150 words. \
+"""
+LABEL_ROLE = """"label" is "Validated" if the answer is about IoT DIY projects and technically sound, otherwise "Not Validated". \
+"""
+
+# Instruction inserted as a system message right before the user turn, so the cached system prompt prefix is unchanged
+FORMAT_PROMPT = f"<|start_header_id|>system<|end_header_id|>\n\n{FORMAT_ROLE}{LABEL_ROLE if STRUCTURED_LABEL else ''}<|eot_id|>"
+
+# Answer, summary and (with STRUCTURED_LABEL=1) verdict of one structured decode
+class StructuredAnswer:
+    def __init__(self, answer: str, summary: Optional[str], verdict: Optional[Verdict], completion_tokens: int):
+        self.answer = answer
+        self.summary = summary
+        self.verdict = verdict
+        self.completion_tokens = completion_tokens
+
+# Put the format instruction in front of the last user turn of a chat prompt
+def structured_prompt(full_prompt: str) -> str:
+    index = full_prompt.rfind("<|start_header_id|>user<|end_header_id|>")
+    return f"{full_prompt[:index]}{FORMAT_PROMPT}{full_prompt[index:]}"
+
+# Answer of a JSON object cut short by the end of the context, as far as it was written
+def partial_answer(text: str) -> str:
+    key = text.find('"answer"')
+    start = text.find('"', text.find(":", key) + 1) if key >= 0 else -1
+    if start < 0:
+        return ""
+    decoder = json.JSONDecoder()
+    # Close the string, dropping the last characters of an escape sequence that was cut in half
+    for end in range(len(text), max(start, len(text) - 6), -1):
+        for tail in ("", '"'):
+            try:
+                return decoder.raw_decode(text[start:end] + tail)[0]
+            except json.JSONDecodeError:
+                pass
+    return ""
+
+# Generate the answer and its summary (and label) of a chat prompt in one decode pass
+@observe()
+def generate_structured(full_prompt: str) -> StructuredAnswer:
+    with acquire("chat") as model, speculative(model, "chat"), llama_timings(model.llama, "chat"):
+        result = model.llama(
+            prompt=structured_prompt(full_prompt),
+            max_tokens=STRUCTURED_MAX_TOKENS or -1,
+            temperature=0.5,
+            top_p=0.5,
+            grammar=LABELED_ANSWER_GRAMMAR if STRUCTURED_LABEL else ANSWER_GRAMMAR,
+            stopping_criteria=stopping_criteria()
+        )
+    text = result["choices"][0]["text"]
+    completion_tokens = result["usage"]["completion_tokens"]
+    # The grammar guarantees valid JSON unless the token budget or the context ran out (or the request was cancelled) first.
+    # The answer written so far is kept; without summary and verdict it is validated and summarized as usual.
+    try:
+        output = json.loads(text)
+    except json.JSONDecodeError:
+        print(f"Structured output cut short after {completion_tokens} tokens")
+        return StructuredAnswer(partial_answer(text).strip(), None, None, completion_tokens)
+
+    summary = output["summary"].strip() or None
+    verdict = None
+    if STRUCTURED_LABEL:
+        # The label is sampled like any other token, so it comes without a confidence
+        verdict = Verdict(output["label"], None, "structured")
+    return StructuredAnswer(output["answer"].strip(), summary, verdict, completion_tokens)
@@ -1,62 +1,179 @@
-import os
-from dotenv import load_dotenv
-from langchain_community.llms import LlamaCpp
-from langchain_core.prompts import PromptTemplate
-from langfuse.callback import CallbackHandler
-import langchain
-langchain.debug = True
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Get summarize model path
-summarize_model_path = os.getenv("MODEL_PATH")
-
-# Get Langfuse environment variables
-Secret_Key = os.getenv("LANGFUSE_SECRET_KEY")
-Public_Key = os.getenv("LANGFUSE_PUBLIC_KEY")
-Host = os.getenv("LANGFUSE_HOST")
-
-# Initialize Langfuse
-langfuse_handler = CallbackHandler(
-    secret_key=Secret_Key,
-    public_key=Public_Key,
-    host=Host
-)
-
-# Define model roles
-MODEL_ROLE_SUM_INPUT = """You are a expert at summarizing. \
-Prohibit to answer the question. \
-If the user input contains a question, summarize the question and return it in the form of a question; do not return a statement or an answer. \
-The response must be a short paragraph, under 150 words. \
-"""
-
-MODEL_ROLE_SUM_OUTPUT = """You are a expert at summarizing. \
-Do not return the summary in the form of a question; you must return a statement or an answer. \
-The response must be a short paragraph, under 150 words. \
-"""
-
-# Define system prompts
-# Remove <|begin_of_text|>
-# RuntimeWarning: Detected duplicate leading "<|begin_of_text|>" in prompt, this will likely reduce response quality, consider removing it...
-#  warnings.warn(
-SYSTEM_PROMPT_INPUT = f"<|start_header_id|>system<|end_header_id|>\n\n{MODEL_ROLE_SUM_INPUT}<|eot_id|>"
-SYSTEM_PROMPT_OUTPUT = f"<|start_header_id|>system<|end_header_id|>\n\n{MODEL_ROLE_SUM_OUTPUT}<|eot_id|>"
-
-# Get the summary of the text
-def summarize(text_input: str, mode: str) -> str:
-    USER_PROMPT = f"""<|start_header_id|>user<|end_header_id|>\n\nSummarizing the following text: {text_input}<|eot_id|><|start_header_id|>assistant<|end_header_id|> \nSummary:\n"""
-    llm=LlamaCpp(
-        model_path=summarize_model_path,
-        temperature=0.1,
-        n_ctx = 2048
-    )
-    
-    # Define summarize prompt
-    if mode == "input":
-        summarize_prompt = PromptTemplate.from_template(f"{SYSTEM_PROMPT_INPUT}""{input_text}")
-    elif mode == "output":
-        summarize_prompt = PromptTemplate.from_template(f"{SYSTEM_PROMPT_OUTPUT}""{input_text}")
-    chain = summarize_prompt | llm
-    summary = chain.invoke(input={"input_text": USER_PROMPT}, config={"callbacks": [langfuse_handler]})
-    return summary
\ No newline at end of file
+import contextvars
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, List
+from dotenv import load_dotenv
+from tracing import observe
+from model_registry import acquire, get_model, get_pool, MODEL_N_CTX
+from speculative import speculative
+from inference import raise_if_cancelled, stopping_criteria
+from summary_cache import summary_cache, summary_key
+from metrics import stage, llama_timings
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Name of the shared model (see model_registry.py) used for summarizing
+SUMMARIZE_MODEL = "chat"
+
+# Tokens generated per summary
+SUMMARY_MAX_TOKENS = 256
+# Largest piece of text summarized in one prompt; longer texts are map-reduced.
+# Leaves room in the context for the summarize prompt and the summary.
+SUMMARY_CHUNK_TOKENS = min(int(os.getenv("SUMMARY_CHUNK_TOKENS", "1536")), MODEL_N_CTX - SUMMARY_MAX_TOKENS - 192)
+# Tokens shared by consecutive chunks so a sentence cut at a boundary is seen whole once
+SUMMARY_CHUNK_OVERLAP = int(os.getenv("SUMMARY_CHUNK_OVERLAP", "64"))
+# Chunks summarized at the same time; each borrows its own model from the pool (MODEL_POOL_SIZE)
+SUMMARY_MAP_WORKERS = int(os.getenv("SUMMARY_MAP_WORKERS", str(get_pool(SUMMARIZE_MODEL).size)))
+
+map_pool = ThreadPoolExecutor(max_workers=max(1, SUMMARY_MAP_WORKERS), thread_name_prefix="summary-map")
+
+# Define model roles
+MODEL_ROLE_SUM_INPUT = """You are a expert at summarizing. \
+Prohibit to answer the question. \
+If the user input contains a question, summarize the question and return it in the form of a question; do not return a statement or an answer. \
+The response must be a short paragraph, under 150 words. \
+"""
+
+MODEL_ROLE_SUM_OUTPUT = """You are a expert at summarizing. \
+Do not return the summary in the form of a question; you must return a statement or an answer. \
+The response must be a short paragraph, under 150 words. \
+"""
+
+MODEL_ROLE_MEMORY = """You maintain the memory of a conversation between a user and an IoT project assistant. \
+Merge the new exchange into the current memory and return the updated memory only. \
+Keep the user's interests, experience level, hardware, decisions and open questions; drop greetings and repetition. \
+The response must be a short paragraph, under 150 words. \
+"""
+
+# Define system prompts
+# Remove <|begin_of_text|>
+# RuntimeWarning: Detected duplicate leading "<|begin_of_text|>" in prompt, this will likely reduce response quality, consider removing it...
+#  warnings.warn(
+SYSTEM_PROMPT_INPUT = f"<|start_header_id|>system<|end_header_id|>\n\n{MODEL_ROLE_SUM_INPUT}<|eot_id|>"
+SYSTEM_PROMPT_OUTPUT = f"<|start_header_id|>system<|end_header_id|>\n\n{MODEL_ROLE_SUM_OUTPUT}<|eot_id|>"
+SYSTEM_PROMPT_MEMORY = f"<|start_header_id|>system<|end_header_id|>\n\n{MODEL_ROLE_MEMORY}<|eot_id|>"
+
+# Version of the summarize prompts; cached summaries are only reused for the same prompts
+SUMMARY_PROMPT_VERSION = hashlib.sha256(f"{SYSTEM_PROMPT_INPUT}{SYSTEM_PROMPT_OUTPUT}".encode("utf-8")).hexdigest()[:16]
+
+# Get the summary of the text, reusing a cached one when the same text was summarized before.
+# Texts longer than SUMMARY_CHUNK_TOKENS are map-reduced (see summarize_stream).
+@observe()
+def summarize(text_input: str, mode: str) -> str:
+    summary = None
+    for event in summarize_stream(text_input, mode):
+        summary = event["summary"]
+    return summary
+
+# Summarize the text, yielding progress events; the last one carries the final summary.
+#   {"stage": "map", "chunk": i, "chunks": n, "summary": ...}    one per chunk, in completion order
+#   {"stage": "reduce", "level": l, "group": i, "groups": n, "summary": ...}
+#   {"stage": "done", "chunks": n, "summary": ...}
+def summarize_stream(text_input: str, mode: str) -> Iterator[dict]:
+    chunks = split_tokens(text_input)
+    if len(chunks) == 1:
+        yield {"stage": "done", "chunks": 1, "summary": cached_summary(text_input, mode)}
+        return
+    
+    # Map: summarize the chunks in parallel
+    summaries: List[str] = [None] * len(chunks)
+    # Each task runs in a copy of the caller's context, so it stops when the caller's request is cancelled
+    futures = {map_pool.submit(contextvars.copy_context().run, cached_summary, chunk, mode): index for index, chunk in enumerate(chunks)}
+    for future in as_completed(futures):
+        index = futures[future]
+        summaries[index] = future.result()
+        yield {"stage": "map", "chunk": index, "chunks": len(chunks), "summary": summaries[index]}
+    
+    # Reduce: summarize groups of summaries that fit in one prompt until a single one is left
+    level = 0
+    while len(summaries) > 1:
+        level += 1
+        groups = group_summaries(summaries)
+        futures = {map_pool.submit(contextvars.copy_context().run, cached_summary, "\n\n".join(group), mode): index for index, group in enumerate(groups)}
+        summaries = [None] * len(groups)
+        for future in as_completed(futures):
+            index = futures[future]
+            summaries[index] = future.result()
+            yield {"stage": "reduce", "level": level, "group": index, "groups": len(groups), "summary": summaries[index]}
+    
+    yield {"stage": "done", "chunks": len(chunks), "summary": summaries[0]}
+
+# Split the text on token boundaries into chunks of SUMMARY_CHUNK_TOKENS overlapping by SUMMARY_CHUNK_OVERLAP
+def split_tokens(text_input: str) -> List[str]:
+    tokenizer = get_model(SUMMARIZE_MODEL).tokenizer
+    tokens = tokenizer.encode(text_input, False)
+    if len(tokens) <= SUMMARY_CHUNK_TOKENS:
+        return [text_input]
+    step = SUMMARY_CHUNK_TOKENS - min(SUMMARY_CHUNK_OVERLAP, SUMMARY_CHUNK_TOKENS // 2)
+    return [tokenizer.decode(tokens[start:start + SUMMARY_CHUNK_TOKENS]) for start in range(0, len(tokens) - SUMMARY_CHUNK_OVERLAP, step)]
+
+# Pack consecutive summaries into groups that fit in one summarize prompt (at least two per group)
+def group_summaries(summaries: List[str]) -> List[List[str]]:
+    tokenizer = get_model(SUMMARIZE_MODEL).tokenizer
+    groups, group, used = [], [], 0
+    for summary in summaries:
+        tokens = len(tokenizer.encode(summary, False)) + 2
+        if len(group) >= 2 and used + tokens > SUMMARY_CHUNK_TOKENS:
+            groups.append(group)
+            group, used = [], 0
+        group.append(summary)
+        used += tokens
+    groups.append(group)
+    return groups
+
+# Summary of a text that fits in one prompt, through the summary cache
+def cached_summary(text_input: str, mode: str) -> str:
+    model_id = os.path.basename(get_pool(SUMMARIZE_MODEL).model_path or SUMMARIZE_MODEL)
+    key = summary_key(text_input, mode, model_id, SUMMARY_PROMPT_VERSION)
+    summary = summary_cache.get(key)
+    if summary is None:
+        with stage("summary_generate", mode=mode):
+            summary = generate_summary(text_input, mode)
+        # A summary cut short by a cancelled request is not cached
+        raise_if_cancelled()
+        summary_cache.put(key, mode, summary)
+    return summary
+
+# Generate the summary of the text with the model
+def generate_summary(text_input: str, mode: str) -> str:
+    USER_PROMPT = f"""<|start_header_id|>user<|end_header_id|>\n\nSummarizing the following text: {text_input}<|eot_id|><|start_header_id|>assistant<|end_header_id|> \nSummary:\n"""
+    
+    # Define summarize prompt
+    if mode == "input":
+        summarize_prompt = f"{SYSTEM_PROMPT_INPUT}{USER_PROMPT}"
+    elif mode == "output":
+        summarize_prompt = f"{SYSTEM_PROMPT_OUTPUT}{USER_PROMPT}"
+    else:
+        raise ValueError(f"Unknown summarize mode: {mode}")
+    
+    # Borrow the shared model instead of loading the GGUF again
+    with acquire(SUMMARIZE_MODEL) as model, speculative(model, "summarize"), llama_timings(model.llama, "summarize"):
+        result = model.llama(
+            prompt=summarize_prompt,
+            max_tokens=SUMMARY_MAX_TOKENS,
+            temperature=0.1,
+            top_p=0.95,
+            top_k=40,
+            repeat_penalty=1.1,
+            stopping_criteria=stopping_criteria()
+        )
+    summary = result["choices"][0]["text"]
+    return summary
+
+# Fold one conversation turn into the running memory of a session
+@observe()
+def fold_memory(memory: str, request: str, response: str) -> str:
+    USER_PROMPT = f"""<|start_header_id|>user<|end_header_id|>\n\nCurrent memory: {memory or "(empty)"}\n\nNew exchange:\nUser: {request}\nAssistant: {response}<|eot_id|><|start_header_id|>assistant<|end_header_id|> \nMemory:\n"""
+    
+    with acquire(SUMMARIZE_MODEL) as model, speculative(model, "summarize"), llama_timings(model.llama, "memory"):
+        result = model.llama(
+            prompt=f"{SYSTEM_PROMPT_MEMORY}{USER_PROMPT}",
+            max_tokens=256,
+            temperature=0.1,
+            top_p=0.95,
+            top_k=40,
+            repeat_penalty=1.1
+        )
+    return result["choices"][0]["text"].strip()
@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from dotenv import load_dotenv
+from sqlalchemy import delete, select, func
+from database import SessionLocal, SummaryCacheEntry
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Entries kept in the in-memory tier
+SUMMARY_CACHE_MEMORY_SIZE = int(os.getenv("SUMMARY_CACHE_MEMORY_SIZE", "512"))
+# Rows kept in the summary_cache table of the conversations database
+SUMMARY_CACHE_MAX_ROWS = int(os.getenv("SUMMARY_CACHE_MAX_ROWS", "10000"))
+# Seconds a summary stays valid (0 keeps it forever)
+SUMMARY_CACHE_TTL = float(os.getenv("SUMMARY_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Content address of a summary: text, mode, model and prompt version
+def summary_key(text_input: str, mode: str, model: str, prompt_version: str) -> str:
+    digest = hashlib.sha256()
+    for part in (model, mode, prompt_version, text_input):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+# Two-tier cache: an LRU dict in front of the summary_cache table.
+# The table is read and written through the database module's async engine, on the server's event loop
+# (set by start() at startup); before that, and in processes without one, only the memory tier is used.
+class SummaryCache:
+    def __init__(self, memory_size: int = SUMMARY_CACHE_MEMORY_SIZE, max_rows: int = SUMMARY_CACHE_MAX_ROWS, ttl: float = SUMMARY_CACHE_TTL):
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    # Use the table from now on; `loop` is the event loop of the database engine
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl > 0 and time.time() - created_at > self.ttl
+
+    def _remember(self, key: str, summary: str, created_at: float):
+        with self._lock:
+            self._memory[key] = (summary, created_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    # Run a query of the table from a worker thread and wait for it; False when the table is not available
+    def _run(self, coroutine):
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if self._loop is None or on_loop:
+            # Waiting on the loop from the loop itself would never return
+            coroutine.close()
+            return False
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[1]):
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            self._memory.pop(key, None)
+
+        row = self._run(self._get_row(key))
+        if not row or self._expired(row[1]):
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._remember(key, row[0], row[1])
+        return row[0]
+
+    async def _get_row(self, key: str) -> Optional[tuple]:
+        async with SessionLocal() as db_session:
+            row = await db_session.get(SummaryCacheEntry, key)
+            return (row.summary, row.created_at) if row is not None else None
+
+    def put(self, key: str, mode: str, summary: str):
+        created_at = time.time()
+        self._remember(key, summary, created_at)
+        try:
+            self._run(self._put_row(key, mode, summary, created_at))
+        except Exception as e:
+            # The cache is best effort, a failed write must not fail the request
+            print(e)
+
+    async def _put_row(self, key: str, mode: str, summary: str, created_at: float):
+        async with SessionLocal() as db_session:
+            await db_session.merge(SummaryCacheEntry(key=key, mode=mode, summary=summary, created_at=created_at))
+            await db_session.commit()
+            # Trim expired and overflowing rows every so often instead of on every write
+            self._writes += 1
+            if self._writes % 100 == 0:
+                await self._evict(db_session)
+
+    async def _evict(self, db_session):
+        if self.ttl > 0:
+            await db_session.execute(delete(SummaryCacheEntry).where(SummaryCacheEntry.created_at < time.time() - self.ttl))
+        rows = await db_session.scalar(select(func.count()).select_from(SummaryCacheEntry))
+        if rows > self.max_rows:
+            cutoff = await db_session.scalar(
+                select(SummaryCacheEntry.created_at).order_by(SummaryCacheEntry.created_at.desc()).offset(self.max_rows).limit(1)
+            )
+            await db_session.execute(delete(SummaryCacheEntry).where(SummaryCacheEntry.created_at <= cutoff))
+        await db_session.commit()
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else None,
+        }
+
+summary_cache = SummaryCache()
@@ -0,0 +1,151 @@
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Number of background summarization threads
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "1"))
+# Attempts per job before it is marked as failed
+SUMMARY_MAX_ATTEMPTS = int(os.getenv("SUMMARY_MAX_ATTEMPTS", "3"))
+# Finished jobs kept for status lookups
+SUMMARY_JOB_HISTORY = int(os.getenv("SUMMARY_JOB_HISTORY", "1000"))
+
+# One deferred summary of a saved conversation row
+class SummaryJob:
+    def __init__(self, row_id: int, text: str, mode: str):
+        self.id = uuid.uuid4().hex
+        self.row_id = row_id
+        self.text = text
+        self.mode = mode
+        self.status = "queued"
+        self.attempts = 0
+        self.summary: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "row_id": self.row_id,
+            "status": self.status,
+            "attempts": self.attempts,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+# Summarizes texts off the request path.
+# `summarize(text, mode)` produces the summary and `on_done(job, summary)` stores it.
+class SummaryQueue:
+    def __init__(self, summarize: Callable[[str, str], str], on_done: Callable[[SummaryJob, str], None],
+                 workers: int = SUMMARY_WORKERS, max_attempts: int = SUMMARY_MAX_ATTEMPTS):
+        self.summarize = summarize
+        self.on_done = on_done
+        self.max_attempts = max_attempts
+        self._queue = queue.Queue()
+        # Retries waiting out their backoff: (not before, order, job), off the queue so they hold up no other job
+        self._delayed = []
+        self._order = itertools.count()
+        self._jobs: "OrderedDict[str, SummaryJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"summary-worker-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, row_id: int, text: str, mode: str = "output") -> SummaryJob:
+        if self._stopping:
+            raise RuntimeError("Summary queue is shutting down")
+        job = SummaryJob(row_id, text, mode)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > SUMMARY_JOB_HISTORY:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.status in ("queued", "running"):
+                    break
+                self._jobs.popitem(last=False)
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[SummaryJob]:
+        return self._jobs.get(job_id)
+
+    # Queue the retries whose backoff is over; returns the seconds until the next one is due, or None
+    def _promote(self) -> Optional[float]:
+        with self._lock:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, job = heapq.heappop(self._delayed)
+                self._queue.put(job)
+            return self._delayed[0][0] - now if self._delayed else None
+
+    def _worker(self):
+        while True:
+            try:
+                job = self._queue.get(timeout=self._promote())
+            except queue.Empty:
+                continue
+            if job is None:
+                self._queue.task_done()
+                return
+            job.status = "running"
+            job.attempts += 1
+            try:
+                job.summary = self.summarize(job.text, job.mode)
+                self.on_done(job, job.summary)
+                job.status = "done"
+                job.finished_at = time.time()
+                self.completed += 1
+            except Exception as e:
+                job.error = str(e)
+                if job.attempts < self.max_attempts and not self._stopping:
+                    # Back off before retrying so a transient failure can clear
+                    job.status = "queued"
+                    self.retried += 1
+                    with self._lock:
+                        heapq.heappush(self._delayed, (time.monotonic() + 2 ** job.attempts, next(self._order), job))
+                else:
+                    job.status = "failed"
+                    job.finished_at = time.time()
+                    self.failed += 1
+                    print(f"Summary job {job.id} failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    # Finish the queued jobs (up to `timeout` seconds) and stop the workers
+    def drain(self, timeout: float = 60):
+        self._stopping = True
+        deadline = time.monotonic() + timeout
+        # Once the workers are gone (drained before) nothing is left to wait for
+        while (self._queue.unfinished_tasks or self._delayed) and any(thread.is_alive() for thread in self._threads) \
+                and time.monotonic() < deadline:
+            time.sleep(0.1)
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=max(0.0, deadline - time.monotonic()))
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "backing_off": len(self._delayed),
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
@@ -0,0 +1,297 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import httpx
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Runs REPLICAS copies of main.py, each pinned to its own cores, behind a router that sends
+# every session to the same replica so its prefix and context caches stay warm:
+#   python supervisor.py
+# The GGUF is mmapped, so the replicas share one copy of the weights in the page cache.
+# A session moves when its replica goes down or comes back (or with X-Replica), so the replicas
+# check their cached contexts against the database before using them (CONTEXT_CACHE_VERIFY in main.py).
+REPLICAS = int(os.getenv("REPLICAS", "2"))
+REPLICA_HOST = os.getenv("REPLICA_HOST", "127.0.0.1")
+REPLICA_BASE_PORT = int(os.getenv("REPLICA_BASE_PORT", "8100"))
+ROUTER_HOST = os.getenv("ROUTER_HOST", "0.0.0.0")
+ROUTER_PORT = int(os.getenv("ROUTER_PORT", "8000"))
+# Seconds between health checks, and the longest wait before restarting a replica that keeps dying
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", "2"))
+REPLICA_MAX_BACKOFF = float(os.getenv("REPLICA_MAX_BACKOFF", "60"))
+REPLICA_HEALTH_PATH = os.getenv("REPLICA_HEALTH_PATH", "/readyz")
+# Longest request the router waits for (generation included)
+ROUTER_TIMEOUT = float(os.getenv("ROUTER_TIMEOUT", "600"))
+
+# Headers that belong to one connection and are not forwarded
+HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers", "transfer-encoding", "upgrade", "host"}
+# Paths that carry the session id, e.g. /history/{session_id}
+SESSION_PATH = re.compile(r"^/(?:history|delete-history|sessions)/([^/]+)")
+# Jobs live in the replica that created them and are looked up on every replica
+JOB_PATH = re.compile(r"^/(?:summary-jobs|batch)/[^/]+$")
+# Deletes run on the session's replica, then on every other one so none keeps the session in its context cache
+BROADCAST_PATH = re.compile(r"^/delete-history/[^/]+$")
+# Semantic cache index of each replica: <SEMANTIC_CACHE_PATH>.<index>, so no two processes write the same files
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "./semantic_cache")
+
+# Split the cores this process may run on into `count` disjoint sets (shared when there are fewer cores than replicas)
+def split_cores(count: int) -> List[List[int]]:
+    cores = sorted(os.sched_getaffinity(0))
+    per_replica = max(1, len(cores) // count)
+    return [cores[i * per_replica:(i + 1) * per_replica] or cores for i in range(count)]
+
+# One uvicorn process running main:app on its own port and cores
+class Replica:
+    def __init__(self, index: int, port: int, cores: List[int]):
+        self.index = index
+        self.port = port
+        self.cores = cores
+        self.url = f"http://{REPLICA_HOST}:{port}"
+        self.process: Optional[subprocess.Popen] = None
+        self.healthy = False
+        self.started_at: Optional[float] = None
+        self.restarts = 0
+        self.backoff = 1.0
+        self.next_start = 0.0
+        self.requests = 0
+        self.in_flight = 0
+
+    def start(self):
+        env = dict(os.environ, REPLICA_INDEX=str(self.index), SEMANTIC_CACHE_PATH=f"{SEMANTIC_CACHE_PATH}.{self.index}")
+        # llama.cpp would otherwise start a thread per core of the machine
+        env.setdefault("MODEL_N_THREADS", str(len(self.cores)))
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", REPLICA_HOST, "--port", str(self.port)],
+            env=env
+        )
+        # Set before the model loads, so every llama.cpp thread inherits it
+        try:
+            os.sched_setaffinity(self.process.pid, self.cores)
+        except ProcessLookupError:
+            # Exited right away, the monitor restarts it
+            pass
+        self.started_at = time.time()
+        print(f"Started replica {self.index} (pid {self.process.pid}) on port {self.port}, cores {self.cores}")
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self, timeout: float = 30):
+        if not self.alive():
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+    def to_dict(self) -> dict:
+        return {
+            "index": self.index,
+            "url": self.url,
+            "pid": self.process.pid if self.process is not None else None,
+            "cores": self.cores,
+            "healthy": self.healthy,
+            "started_at": self.started_at,
+            "restarts": self.restarts,
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+        }
+
+# Keeps the replicas running and picks the replica of each request
+class Supervisor:
+    def __init__(self, count: int = REPLICAS):
+        self.replicas = [
+            Replica(index, REPLICA_BASE_PORT + index, cores)
+            for index, cores in enumerate(split_cores(count))
+        ]
+        self.client = httpx.AsyncClient(timeout=ROUTER_TIMEOUT)
+        self.rerouted = 0
+
+    def start(self):
+        for replica in self.replicas:
+            replica.start()
+
+    # Restart dead replicas (with exponential backoff) and track which ones answer their health check
+    async def monitor(self):
+        while True:
+            for replica in self.replicas:
+                if not replica.alive():
+                    if replica.healthy:
+                        print(f"Replica {replica.index} exited with code {replica.process.returncode}, its sessions move to the other replicas")
+                    replica.healthy = False
+                    if time.monotonic() >= replica.next_start:
+                        replica.restarts += 1
+                        replica.next_start = time.monotonic() + replica.backoff
+                        replica.backoff = min(REPLICA_MAX_BACKOFF, replica.backoff * 2)
+                        replica.start()
+                    continue
+                try:
+                    response = await self.client.get(replica.url + REPLICA_HEALTH_PATH, timeout=REPLICA_HEALTH_INTERVAL)
+                    healthy = response.status_code == 200
+                except httpx.HTTPError:
+                    healthy = False
+                if healthy and not replica.healthy:
+                    print(f"Replica {replica.index} is serving")
+                    replica.backoff = 1.0
+                replica.healthy = healthy
+            await asyncio.sleep(REPLICA_HEALTH_INTERVAL)
+
+    def live(self) -> List[Replica]:
+        return [replica for replica in self.replicas if replica.healthy]
+
+    # Rendezvous hashing: a session keeps its replica while that replica is up, and only the
+    # sessions of a replica that goes down move (spread over the others)
+    def for_session(self, session_id: str) -> Optional[Replica]:
+        live = self.live()
+        if not live:
+            return None
+        return max(live, key=lambda replica: hashlib.blake2b(f"{session_id}:{replica.index}".encode("utf-8"), digest_size=8).digest())
+
+    # Least busy replica, for requests without a session
+    def least_loaded(self) -> Optional[Replica]:
+        live = self.live()
+        if not live:
+            return None
+        return min(live, key=lambda replica: replica.in_flight)
+
+    def stop(self):
+        for replica in self.replicas:
+            if replica.alive():
+                replica.process.terminate()
+        for replica in self.replicas:
+            replica.stop()
+
+    def stats(self) -> dict:
+        return {
+            "replicas": [replica.to_dict() for replica in self.replicas],
+            "live": len(self.live()),
+            "rerouted": self.rerouted,
+        }
+
+supervisor = Supervisor()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    supervisor.start()
+    monitor_task = asyncio.create_task(supervisor.monitor())
+    yield
+    monitor_task.cancel()
+    await asyncio.to_thread(supervisor.stop)
+    await supervisor.client.aclose()
+
+router = FastAPI(lifespan=lifespan)
+
+# Session id of a request, from its path or its JSON body
+def session_of(path: str, body: bytes) -> Optional[str]:
+    match = SESSION_PATH.match(path)
+    if match:
+        return match.group(1)
+    if body:
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return None
+        if isinstance(payload, dict) and isinstance(payload.get("session_id"), str):
+            return payload["session_id"]
+    return None
+
+def unavailable() -> JSONResponse:
+    return JSONResponse(status_code=503, content={"detail": "No replica is serving"}, headers={"Retry-After": str(int(REPLICA_HEALTH_INTERVAL) + 1)})
+
+# Send the request to a replica and stream its response back (Server-Sent Events included).
+# Closing the client connection closes the upstream one, so the replica cancels the work.
+async def forward(replica: Replica, request: Request, body: bytes):
+    headers = [(name, value) for name, value in request.headers.items() if name.lower() not in HOP_HEADERS]
+    upstream = supervisor.client.build_request(
+        request.method, replica.url + request.url.path, params=request.query_params, headers=headers, content=body
+    )
+    replica.requests += 1
+    replica.in_flight += 1
+    try:
+        response = await supervisor.client.send(upstream, stream=True)
+    except BaseException:
+        replica.in_flight -= 1
+        raise
+
+    async def close():
+        replica.in_flight -= 1
+        await response.aclose()
+
+    return response, StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers={name: value for name, value in response.headers.items() if name.lower() not in HOP_HEADERS},
+        background=BackgroundTask(close)
+    )
+
+# GET method to retrieve the replicas and their routing counters
+@router.get("/replicas")
+def get_replicas():
+    return supervisor.stats()
+
+# Every other request goes to a replica
+@router.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+async def route(request: Request):
+    body = await request.body()
+    path = request.url.path
+
+    # A job is answered by the replica that has it
+    if JOB_PATH.match(path):
+        result = None
+        for replica in supervisor.live():
+            upstream, result = await forward(replica, request, body)
+            if upstream.status_code != 404:
+                return result
+            await result.background()
+        return result if result is not None else unavailable()
+
+    if BROADCAST_PATH.match(path) and request.method == "DELETE":
+        owner = supervisor.for_session(session_of(path, body))
+        if owner is None:
+            return unavailable()
+        _, result = await forward(owner, request, body)
+        for replica in supervisor.live():
+            if replica is not owner:
+                try:
+                    _, other = await forward(replica, request, body)
+                    await other.background()
+                except httpx.HTTPError as e:
+                    print(f"Replica {replica.index} missed the delete of {path}: {e}")
+        return result
+
+    # X-Replica pins a request, e.g. to scrape the /metrics of each replica
+    pinned = request.headers.get("x-replica")
+    session_id = session_of(path, body)
+    for _ in range(2):
+        if pinned is not None:
+            replica = next((r for r in supervisor.live() if str(r.index) == pinned), None)
+        elif session_id is not None:
+            replica = supervisor.for_session(session_id)
+        else:
+            replica = supervisor.least_loaded()
+        if replica is None:
+            return unavailable()
+        try:
+            return (await forward(replica, request, body))[1]
+        except httpx.ConnectError:
+            # The replica went down since its last health check and never got the request
+            replica.healthy = False
+            supervisor.rerouted += 1
+    return unavailable()
+
+if __name__ == "__main__":
+    uvicorn.run(router, host=ROUTER_HOST, port=ROUTER_PORT)
@@ -0,0 +1,90 @@
+import json
+import os
+import time
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("llama_cpp")
+pytest.importorskip("aiosqlite")
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # Configure before main is imported: its settings are read at import
+    monkeypatch.setenv("DATABASE_URL", f"sqlite+aiosqlite:///{tmp_path}/chatbox.db")
+    monkeypatch.setenv("BATCH_DIR", str(tmp_path))
+    monkeypatch.setenv("MODEL_LOAD", "lazy")
+    monkeypatch.chdir(tmp_path)
+    from fastapi.testclient import TestClient
+    import batch
+    import main
+    monkeypatch.setattr(batch, "BATCH_DIR", str(tmp_path))
+
+    # Answer records without a model
+    async def process(record: dict, idempotency_key: str) -> dict:
+        return {"session_id": record["session_id"], "response": record["request"].upper(), "key": idempotency_key}
+
+    monkeypatch.setattr(main.batch_runner, "process", process)
+    monkeypatch.setattr(main.lifecycle, "loaded", True)
+    # One chat slot stays free for interactive requests
+    main.executor.configure("chat", 2)
+    with TestClient(main.app) as client:
+        yield client
+
+def test_batch_job_processes_jsonl(client, tmp_path):
+    records = [{"session_id": "a", "request": "one"}, {"session_id": "b", "request": "two"}, {"session_id": "a", "request": "three"}]
+    (tmp_path / "in.jsonl").write_text("".join(json.dumps(record) + "\n" for record in records))
+
+    created = client.post("/batch", json={"input_path": "in.jsonl", "output_path": "out.jsonl"})
+    assert created.status_code == 200
+    job_id = created.json()["id"]
+
+    deadline = time.monotonic() + 10
+    while True:
+        job = client.get(f"/batch/{job_id}").json()
+        if job["status"] != "running" or time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+    assert job["status"] == "done"
+    assert job["completed"] == 3 and job["failed"] == 0
+
+    lines = [json.loads(line) for line in (tmp_path / "out.jsonl").read_text().splitlines()]
+    assert sorted(line["line"] for line in lines) == [0, 1, 2]
+    assert {line["response"]["response"] for line in lines} == {"ONE", "TWO", "THREE"}
+    assert os.path.exists(tmp_path / "out.jsonl.checkpoint")
+
+def test_batch_needs_a_free_chat_slot(client):
+    import main
+    main.executor.configure("chat", 1)
+    response = client.post("/batch", json={"input_path": "in.jsonl", "output_path": "out.jsonl"})
+    assert response.status_code == 409
+
+def test_batch_rejects_paths_outside_batch_dir(client):
+    response = client.post("/batch", json={"input_path": "../in.jsonl", "output_path": "out.jsonl"})
+    assert response.status_code == 400
+
+def test_malformed_line_is_checkpointed(tmp_path):
+    import asyncio
+    import batch
+
+    seen = []
+
+    # Runs after the malformed line 0 was handled: its result must already be on disk
+    async def process(record: dict, idempotency_key: str) -> dict:
+        seen.append(batch.Checkpoint(str(tmp_path / "out.jsonl.checkpoint")).watermark)
+        seen.append(len((tmp_path / "out.jsonl").read_text().splitlines()))
+        return {"response": record["request"]}
+
+    (tmp_path / "in.jsonl").write_text('not json\n{"session_id": "a", "request": "one"}\n')
+
+    async def run():
+        runner = batch.BatchRunner(process, concurrency=1)
+        job = runner.submit(str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"))
+        await job.task
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == "done" and job.failed == 1 and job.completed == 1
+    assert seen == [1, 1]
+    # A resumed run skips both lines instead of writing the malformed one again
+    assert asyncio.run(run()).skipped == 2
+    assert len((tmp_path / "out.jsonl").read_text().splitlines()) == 2
@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("dotenv")
+
+from context_cache import ContextCache, CachedTurn, SessionContext
+
+def turn(row_id: int) -> CachedTurn:
+    return CachedTurn(row_id, f"turn {row_id}", 10)
+
+def test_reload_after_invalidate_is_cached():
+    cache = ContextCache(max_turns=10)
+    cache.append("a", turn(1))
+    cache.invalidate("a")
+
+    entry, seq = cache.get("a")
+    assert entry is None
+    cache.put("a", SessionContext([turn(2)]), seq)
+
+    entry, _ = cache.get("a")
+    assert entry is not None and [t.id for t in entry.turns] == [2]
+    assert cache.stats()["sessions"] == 1
+
+def test_load_that_raced_a_write_is_not_cached():
+    cache = ContextCache(max_turns=10)
+    entry, seq = cache.get("a")
+    # A turn is committed while the context is being loaded
+    cache.append("a", turn(1))
+    cache.put("a", SessionContext([]), seq)
+
+    entry, _ = cache.get("a")
+    assert entry is None
+
+def test_tip_is_the_newest_cached_turn():
+    cache = ContextCache(max_turns=10)
+    assert cache.tip("a") is None
+    cache.put("a", SessionContext([turn(3), turn(7)]), cache.get("a")[1])
+    assert cache.tip("a") == 7
+    assert SessionContext([], CachedTurn(5, "memory", 10)).tip == 5
+    assert SessionContext([]).tip == 0
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("llama_cpp")
+pytest.importorskip("aiosqlite")
+
+def test_disconnect_cancels_generate_response(tmp_path, monkeypatch):
+    # Configure before main is imported: its settings are read at import
+    monkeypatch.setenv("DATABASE_URL", f"sqlite+aiosqlite:///{tmp_path}/chatbox.db")
+    monkeypatch.setenv("MODEL_LOAD", "lazy")
+    monkeypatch.chdir(tmp_path)
+    import inference
+    import main
+    monkeypatch.setattr(main.lifecycle, "loaded", True)
+    monkeypatch.setattr(main, "DISCONNECT_POLL_INTERVAL", 0.05)
+
+    cancelled = []
+    cancel = inference.Slot.cancel
+
+    def spy(slot, reason):
+        cancelled.append(reason)
+        cancel(slot, reason)
+
+    monkeypatch.setattr(inference.Slot, "cancel", spy)
+
+    # Stands in for generation: runs until the slot is cancelled
+    async def run_pipeline(request, slot, idempotency_key=None):
+        for _ in range(100):
+            slot.raise_if_cancelled()
+            await asyncio.sleep(0.05)
+        raise AssertionError("the disconnect was not noticed")
+
+    monkeypatch.setattr(main, "run_pipeline", run_pipeline)
+
+    async def run():
+        await main.init_db()
+        body = json.dumps({"session_id": "a", "request": "hello"}).encode("utf-8")
+        disconnected = asyncio.Event()
+        sent = []
+
+        async def receive():
+            if body and not sent:
+                sent.append(True)
+                return {"type": "http.request", "body": body, "more_body": False}
+            # The client goes away while the answer is being generated
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+            "path": "/generate-response", "raw_path": b"/generate-response", "root_path": "", "query_string": b"",
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            "client": ("127.0.0.1", 1), "server": ("testserver", 80),
+        }
+        asyncio.get_running_loop().call_later(0.3, disconnected.set)
+        await asyncio.wait_for(main.app(scope, receive, send), 10)
+        return messages
+
+    messages = asyncio.run(run())
+    assert cancelled == ["disconnect"]
+    assert messages[0]["status"] == 499
@@ -0,0 +1,29 @@
+import asyncio
+import time
+import pytest
+
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from database import Base, IdempotencyRecord, IdempotencyKeyMismatchError, get_idempotency_record
+
+def test_key_is_scoped_to_its_session_and_request(tmp_path):
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/idempotency.db")
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        sessions = async_sessionmaker(engine, expire_on_commit=False)
+        async with sessions() as db_session:
+            db_session.add(IdempotencyRecord(key="k", session_id="a", chatbox_id=1, request_hash="h", response="{}", created_at=time.time()))
+            await db_session.commit()
+
+            assert (await get_idempotency_record(db_session, "k", "a", "h")).chatbox_id == 1
+            assert await get_idempotency_record(db_session, "other", "a", "h") is None
+            # Another session must not read the stored response
+            with pytest.raises(IdempotencyKeyMismatchError):
+                await get_idempotency_record(db_session, "k", "b", "h")
+            with pytest.raises(IdempotencyKeyMismatchError):
+                await get_idempotency_record(db_session, "k", "a", "other request")
+        await engine.dispose()
+
+    asyncio.run(run())
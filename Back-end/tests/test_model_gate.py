@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("llama_cpp")
+pytest.importorskip("aiosqlite")
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # Configure before main is imported: its settings are read at import
+    monkeypatch.setenv("DATABASE_URL", f"sqlite+aiosqlite:///{tmp_path}/chatbox.db")
+    monkeypatch.setenv("MODEL_LOAD", "lazy")
+    monkeypatch.chdir(tmp_path)
+    from fastapi.testclient import TestClient
+    import main
+    monkeypatch.setattr(main.lifecycle, "loaded", False)
+    monkeypatch.setattr(main.lifecycle, "started", True)
+    # Without the lifespan: nothing loads unless a request asks for it
+    return TestClient(main.app)
+
+def test_model_routes_wait_for_a_background_load(client, monkeypatch):
+    import main
+    monkeypatch.setattr(main.lifecycle, "mode", "background")
+    response = client.post("/generate-response", json={"session_id": "a", "request": "hello"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "5"
+    # Routes without a model are answered meanwhile
+    assert client.get("/summary-jobs/unknown").status_code == 404
+    assert client.get("/healthz").status_code == 200
+
+def test_lazy_mode_loads_only_for_model_routes(client, monkeypatch):
+    import main
+    loads = []
+
+    async def load_models():
+        loads.append(True)
+        raise RuntimeError("no model here")
+
+    monkeypatch.setattr(main.lifecycle, "mode", "lazy")
+    monkeypatch.setattr(main.lifecycle, "_task", None)
+    monkeypatch.setattr(main, "load_models", load_models)
+    assert client.get("/summary-jobs/unknown").status_code == 404
+    assert loads == []
+    assert client.post("/validation", json={"mode": "input", "request": "esp32 sensor"}).status_code == 503
+    assert loads == [True]
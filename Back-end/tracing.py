@@ -0,0 +1,274 @@
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Where sampled spans go: "langfuse", "jsonl" or "none" (default: langfuse when its keys are set)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "langfuse" if os.getenv("LANGFUSE_PUBLIC_KEY") else "none")
+# Fraction of traces recorded; a trace is sampled as a whole at its first span
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+# Spans waiting for export; new spans are dropped while the buffer is full
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "2048"))
+# Spans sent per batch, and seconds before a partial batch is sent
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "64"))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "5"))
+# File of the "jsonl" exporter, one span per line
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "traces.jsonl")
+# Record function arguments and results (truncated), which can hold full prompts
+TRACE_CAPTURE_IO = os.getenv("TRACE_CAPTURE_IO", "0") == "1"
+TRACE_IO_MAX_CHARS = int(os.getenv("TRACE_IO_MAX_CHARS", "2000"))
+# Also print every finished span, for local debugging
+TRACE_DEBUG = os.getenv("TRACE_DEBUG", "0") == "1"
+
+# Span of the running trace: None outside a trace, _NOT_SAMPLED inside a trace that is not recorded.
+# Context variables follow the work onto the inference pool (executor.call copies the context).
+_NOT_SAMPLED = object()
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+def _capture(value):
+    if not TRACE_CAPTURE_IO:
+        return None
+    text = value if isinstance(value, str) else repr(value)
+    return text[:TRACE_IO_MAX_CHARS]
+
+# One timed function call of a trace
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str]):
+        self.name = name
+        self.trace_id = trace_id
+        self.id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end = None
+        self.error = None
+        self.input = None
+        self.output = None
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "id": self.id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": round(1000 * (self.end - self.start), 3),
+            "error": self.error,
+            "input": self.input,
+            "output": self.output,
+        }
+
+# Appends spans to a local file, one JSON object per line
+class JsonlSink:
+    def __init__(self, path: str = TRACE_JSONL_PATH):
+        self.path = path
+
+    def export(self, spans: List[Span]):
+        with open(self.path, "a", encoding="utf-8") as file:
+            for span in spans:
+                file.write(json.dumps(span.to_dict()) + "\n")
+
+    def close(self):
+        pass
+
+# Sends spans to Langfuse; root spans also create their trace
+class LangfuseSink:
+    def __init__(self):
+        # Imported here so the other exporters do not need the SDK
+        from langfuse import Langfuse
+        self.client = Langfuse(
+            secret_key=os.getenv("LANGFUSE_SECRET_KEY"),
+            public_key=os.getenv("LANGFUSE_PUBLIC_KEY"),
+            host=os.getenv("LANGFUSE_HOST")
+        )
+
+    def export(self, spans: List[Span]):
+        for span in spans:
+            start = datetime.fromtimestamp(span.start, timezone.utc)
+            end = datetime.fromtimestamp(span.end, timezone.utc)
+            if span.parent_id is None:
+                self.client.trace(id=span.trace_id, name=span.name, timestamp=start, input=span.input, output=span.output)
+            self.client.span(
+                id=span.id,
+                trace_id=span.trace_id,
+                parent_observation_id=span.parent_id,
+                name=span.name,
+                start_time=start,
+                end_time=end,
+                input=span.input,
+                output=span.output,
+                level="ERROR" if span.error else "DEFAULT",
+                status_message=span.error
+            )
+        self.client.flush()
+
+    def close(self):
+        self.client.shutdown()
+
+# Buffers finished spans and exports them in batches from a background thread.
+# Recording a span never blocks: when the buffer is full (e.g. the collector is down) it is dropped.
+class Tracer:
+    def __init__(self, sink, sample_rate: float = TRACE_SAMPLE_RATE, buffer_size: int = TRACE_BUFFER_SIZE,
+                 batch_size: int = TRACE_BATCH_SIZE, flush_interval: float = TRACE_FLUSH_INTERVAL):
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=buffer_size)
+        self._stopping = threading.Event()
+        self.traces = 0
+        self.sampled = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.exported = 0
+        self.failed = 0
+        self._thread = None
+        if sink is not None:
+            self._thread = threading.Thread(target=self._worker, name="trace-exporter", daemon=True)
+            self._thread.start()
+
+    # Span for a call named `name`, or None when the call is not traced
+    def start_span(self, name: str) -> Optional[Span]:
+        parent = _current_span.get()
+        if parent is _NOT_SAMPLED:
+            return None
+        if parent is None:
+            self.traces += 1
+            if self.sink is None or random.random() >= self.sample_rate:
+                return None
+            self.sampled += 1
+            return Span(name, secrets.token_hex(16), None)
+        return Span(name, parent.trace_id, parent.id)
+
+    def record(self, span: Span):
+        span.end = time.time()
+        if TRACE_DEBUG:
+            print(f"Trace {span.trace_id} span {span.name}: {1000 * (span.end - span.start):.1f} ms{' error: ' + span.error if span.error else ''}")
+        try:
+            self._queue.put_nowait(span)
+            self.recorded += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def _worker(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+                if self._stopping.is_set() and self._queue.empty():
+                    break
+            if not batch:
+                continue
+            try:
+                self.sink.export(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                # The batch is lost, tracing must not hold up or break requests
+                self.failed += len(batch)
+                print(f"Trace export failed: {e}")
+
+    # Export the buffered spans (up to `timeout` seconds) and stop the exporter
+    def drain(self, timeout: float = 10):
+        if self._thread is None:
+            return
+        self.flush_interval = 0.1
+        self._stopping.set()
+        self._thread.join(timeout=timeout)
+        try:
+            self.sink.close()
+        except Exception as e:
+            print(f"Trace exporter did not close cleanly: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "exporter": TRACE_EXPORTER,
+            "sample_rate": self.sample_rate,
+            "traces": self.traces,
+            "sampled": self.sampled,
+            "buffered": self._queue.qsize(),
+            "recorded_spans": self.recorded,
+            "dropped_spans": self.dropped,
+            "exported_spans": self.exported,
+            "failed_spans": self.failed,
+        }
+
+def _make_sink():
+    if TRACE_EXPORTER == "langfuse":
+        return LangfuseSink()
+    if TRACE_EXPORTER == "jsonl":
+        return JsonlSink()
+    if TRACE_EXPORTER == "none":
+        return None
+    raise ValueError(f"Unknown trace exporter: {TRACE_EXPORTER}")
+
+tracer = Tracer(_make_sink())
+
+# Trace calls of the decorated function (sync or async) as spans: `@observe()`
+def observe(name: Optional[str] = None):
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        def enter(args, kwargs):
+            span = tracer.start_span(span_name)
+            if span is None:
+                # Children of an unsampled trace are not sampled again
+                return None, _current_span.set(_NOT_SAMPLED) if _current_span.get() is None else None
+            if TRACE_CAPTURE_IO:
+                span.input = _capture({"args": args, "kwargs": kwargs})
+            return span, _current_span.set(span)
+
+        def leave(span, token, output=None, error=None):
+            if token is not None:
+                _current_span.reset(token)
+            if span is None:
+                return
+            if error is not None:
+                span.error = f"{type(error).__name__}: {error}"
+            elif TRACE_CAPTURE_IO:
+                span.output = _capture(output)
+            tracer.record(span)
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                span, token = enter(args, kwargs)
+                try:
+                    result = await fn(*args, **kwargs)
+                except BaseException as e:
+                    leave(span, token, error=e)
+                    raise
+                leave(span, token, result)
+                return result
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            span, token = enter(args, kwargs)
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                leave(span, token, error=e)
+                raise
+            leave(span, token, result)
+            return result
+        return wrapper
+    return decorator
+
+def stats() -> dict:
+    return tracer.stats()
@@ -1,56 +1,137 @@
-import os
-from dotenv import load_dotenv
-from langchain_community.llms import LlamaCpp
-from langchain_core.prompts import PromptTemplate
-from langfuse.callback import CallbackHandler
-import langchain
-langchain.debug = True
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Get validate model path
-validate_model_path = os.getenv("MODEL_PATH")
-
-# Get Langfuse environment variables
-Secret_Key = os.getenv("LANGFUSE_SECRET_KEY")
-Public_Key = os.getenv("LANGFUSE_PUBLIC_KEY")
-Host = os.getenv("LANGFUSE_HOST")
-
-# Initialize Langfuse
-langfuse_handler = CallbackHandler(
-    secret_key=Secret_Key,
-    public_key=Public_Key,
-    host=Host
-)
-
-# Define model roles
-MODEL_ROLE = """You are a expert at validating technical answers and solutions related to IoT DIY projects. \
-Make sure user iput is technically accurate, feasible, and align with best practices for IoT development \
-If the input has any keywords that is not related to IoT, return 'Not Validated'. \
-If the user input related to IoT DIY projects, return only in format 'Validated'. If not, return only in format 'Not Validated' \
-Return only in 'Validated' or 'Not Validated' format, no further explanation. \
-Do not return a statement or a question. \
-Do not return any other information than 'Validated' or 'Not Validated'. \
-"""
-
-# Define system prompts
-# Remove <|begin_of_text|>
-# RuntimeWarning: Detected duplicate leading "<|begin_of_text|>" in prompt, this will likely reduce response quality, consider removing it...
-#  warnings.warn(
-SYSTEM_PROMPT = f"<|start_header_id|>system<|end_header_id|>\n\n{MODEL_ROLE}<|eot_id|>"
-
-# Check validation of the text
-def validate(text_input: str) -> str:
-    USER_PROMPT = f"""<|start_header_id|>user<|end_header_id|>\n\nValidating the following text: {text_input}<|eot_id|><|start_header_id|>assistant<|end_header_id|> \Validation Result:\n"""
-    llm=LlamaCpp(
-        model_path=validate_model_path,
-        temperature=0.1,
-        n_ctx = 2048
-    )
-    
-    # Define validate prompt
-    validate_prompt = PromptTemplate.from_template(f"{SYSTEM_PROMPT}""{input_text}")
-    chain = validate_prompt | llm
-    result = chain.invoke(input={"input_text": USER_PROMPT}, config={"callbacks": [langfuse_handler]})
-    return result
\ No newline at end of file
+import math
+import os
+import re
+from typing import Optional
+from dotenv import load_dotenv
+from tracing import observe
+from llama_cpp import LlamaGrammar, LogitsProcessorList
+from model_registry import acquire
+from speculative import speculative
+from inference import stopping_criteria
+from metrics import llama_timings
+import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Name of the shared model (see model_registry.py) used for validating
+VALIDATE_MODEL = "chat"
+
+# Define model roles
+MODEL_ROLE = """You are a expert at validating technical answers and solutions related to IoT DIY projects. \
+Make sure user iput is technically accurate, feasible, and align with best practices for IoT development \
+If the input has any keywords that is not related to IoT, return 'Not Validated'. \
+If the user input related to IoT DIY projects, return only in format 'Validated'. If not, return only in format 'Not Validated' \
+Return only in 'Validated' or 'Not Validated' format, no further explanation. \
+Do not return a statement or a question. \
+Do not return any other information than 'Validated' or 'Not Validated'. \
+"""
+
+# Define system prompts
+# Remove <|begin_of_text|>
+# RuntimeWarning: Detected duplicate leading "<|begin_of_text|>" in prompt, this will likely reduce response quality, consider removing it...
+#  warnings.warn(
+SYSTEM_PROMPT = f"<|start_header_id|>system<|end_header_id|>\n\n{MODEL_ROLE}<|eot_id|>"
+
+# Grammar restricting the model to one of the two verdict labels
+VERDICT_GRAMMAR = LlamaGrammar.from_string('root ::= "Validated" | "Not Validated"', verbose=False)
+
+# Keywords used by the lexical pre-filter
+IOT_KEYWORDS = {
+    "iot", "arduino", "esp32", "esp8266", "raspberry", "microcontroller", "sensor", "sensors",
+    "actuator", "actuators", "mqtt", "gpio", "i2c", "spi", "uart", "zigbee", "lora", "lorawan",
+    "bluetooth", "ble", "wifi", "relay", "servo", "breadboard", "firmware", "node-red", "blynk",
+    "thingspeak", "dht11", "dht22", "pcb", "soldering", "led", "leds", "automation", "smart",
+    "wireless", "telemetry", "dashboard", "voltage", "battery", "solar",
+}
+OFF_TOPIC_KEYWORDS = {
+    "recipe", "recipes", "poem", "poetry", "lyrics", "movie", "movies", "football", "soccer",
+    "celebrity", "election", "horoscope", "astrology", "dating", "novel", "fashion", "gossip",
+    "cocktail", "religion", "politics",
+}
+# Distinct IoT keywords needed to accept without asking the model
+VALIDATION_ACCEPT_HITS = int(os.getenv("VALIDATION_ACCEPT_HITS", "3"))
+# Distinct off-topic keywords (and no IoT keyword) needed to reject without asking the model
+VALIDATION_REJECT_HITS = int(os.getenv("VALIDATION_REJECT_HITS", "2"))
+
+# Result of validating a text
+class Verdict:
+    def __init__(self, label: str, confidence: Optional[float], stage: str):
+        self.label = label
+        self.confidence = confidence  # None when the stage gives no probability
+        self.stage = stage  # "prefilter", "model" or "structured"
+
+    @property
+    def validated(self) -> bool:
+        return self.label == "Validated"
+
+# Fast lexical check: returns a verdict for clearly on-topic or off-topic texts, None otherwise
+def prefilter(text_input: str) -> Optional[Verdict]:
+    words = set(re.findall(r"[a-z0-9][a-z0-9-]*", text_input.lower()))
+    iot_hits = len(words & IOT_KEYWORDS)
+    off_topic_hits = len(words & OFF_TOPIC_KEYWORDS)
+    if iot_hits >= VALIDATION_ACCEPT_HITS and off_topic_hits == 0:
+        return Verdict("Validated", min(0.99, 0.5 + 0.1 * iot_hits), "prefilter")
+    if iot_hits == 0 and off_topic_hits >= VALIDATION_REJECT_HITS:
+        return Verdict("Not Validated", min(0.99, 0.5 + 0.1 * off_topic_hits), "prefilter")
+    return None
+
+verdicts = metrics.counter("verdicts_total", "Validation verdicts by label and by the stage that decided")
+
+# Classify the text as "Validated" or "Not Validated" with a confidence score
+@observe()
+def classify(text_input: str) -> Verdict:
+    verdict = prefilter(text_input)
+    if verdict is None:
+        with metrics.stage("validate_model"):
+            verdict = classify_with_model(text_input)
+    verdicts.inc(label=verdict.label, stage=verdict.stage)
+    return verdict
+
+# Classify the text with the model, for text the prefilter could not decide
+def classify_with_model(text_input: str) -> Verdict:
+    USER_PROMPT = f"""<|start_header_id|>user<|end_header_id|>\n\nValidating the following text: {text_input}<|eot_id|><|start_header_id|>assistant<|end_header_id|> \Validation Result:\n"""
+
+    # Define validate prompt
+    validate_prompt = f"{SYSTEM_PROMPT}{USER_PROMPT}"
+
+    # Borrow the shared model instead of loading the GGUF again
+    with acquire(VALIDATE_MODEL) as model, speculative(model, "validate"), llama_timings(model.llama, "validate"):
+        # First token of each label; their logits at the first step give the confidence
+        label_tokens = {
+            label: model.llama.tokenize(label.encode("utf-8"), add_bos=False)[0]
+            for label in ("Validated", "Not Validated")
+        }
+        first_logits = {}
+
+        def capture_logits(input_ids, scores):
+            if not first_logits:
+                for label, token in label_tokens.items():
+                    first_logits[label] = float(scores[token])
+            return scores
+
+        # The grammar allows only the two labels, so decoding stops after a few tokens
+        result = model.llama(
+            prompt=validate_prompt,
+            max_tokens=4,
+            temperature=0,
+            grammar=VERDICT_GRAMMAR,
+            logits_processor=LogitsProcessorList([capture_logits]),
+            stopping_criteria=stopping_criteria()
+        )
+
+    label = result["choices"][0]["text"].strip()
+    if label not in label_tokens:
+        label = "Not Validated"
+
+    # Softmax over the two label logits
+    other = "Not Validated" if label == "Validated" else "Validated"
+    if first_logits:
+        confidence = 1.0 / (1.0 + math.exp(first_logits[other] - first_logits[label]))
+    else:
+        confidence = 1.0
+    return Verdict(label, confidence, "model")
+
+# Check validation of the text, returning only the label
+def validate(text_input: str) -> str:
+    return classify(text_input).label
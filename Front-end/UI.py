@@ -1,5 +1,5 @@
 import streamlit as st
-from UI_helper import get_response, get_num_conversations, delete_history
+from UI_helper import stream_response, get_num_conversations, delete_history
 
 st.title("IoT idea generation Bot")
 
@@ -34,9 +34,16 @@ if prompt := st.chat_input("What is up?"):
         st.session_state.messages.append({"role": "assistant", "content": response})
             
     else:
-        response = get_response(prompt)
-        # Display assistant response in chat message container
+        # Display assistant response in chat message container as it is streamed
         with st.chat_message("assistant"):
-            st.markdown(response)
+            placeholder = st.empty()
+            result = {}
+            response = ""
+            for token in stream_response(prompt, result):
+                response += token
+                placeholder.markdown(response + "▌")
+            # The final event may replace the streamed text (e.g. when validation fails)
+            response = result.get('response', response)
+            placeholder.markdown(response)
         # Add assistant response to chat history
         st.session_state.messages.append({"role": "assistant", "content": response})
@@ -2,6 +2,7 @@ import requests
 import json
 
 url_generate = 'http://backend:8000/generate-response'
+url_generate_stream = 'http://backend:8000/generate-response/stream'
 
 def get_response(input):
     data = {"session_id": "222", "request": input}
@@ -18,6 +19,27 @@ def get_response(input):
         else:
             return summary
 
+# Yield the response text as the backend streams it.
+# The final "done" event (validation, summary, row id) is stored in `result`.
+def stream_response(input, result):
+    data = {"session_id": "222", "request": input}
+    with requests.post(url_generate_stream, json=data, stream=True) as API_response:
+        if API_response.status_code != 200:
+            result['response'] = "Error: " + str(API_response.status_code)
+            return
+        event = None
+        for line in API_response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                payload = json.loads(line[len("data:"):].strip())
+                if event == "token":
+                    yield payload['text']
+                elif event == "done":
+                    result.update(payload)
+                elif event == "error":
+                    result['response'] = "Error: " + payload['detail']
+
 def get_num_conversations(input):
     url_get_num_conversations = 'http://backend:8000/history/' + input['session_id']
     API_response = requests.get(url_get_num_conversations)